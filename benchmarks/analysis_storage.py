@@ -0,0 +1,73 @@
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from codec import decode_analysis, encode_analysis
+
+# Сравнение форматов хранения MatchAnalysis.analysis: размер, время кодирования и декодирования.
+# Запуск: python benchmarks/analysis_storage.py [число ключевых моментов]
+
+MOMENT_TYPES = ['CHAT_MESSAGE_FIRSTBLOOD', 'building_kill', 'CHAT_MESSAGE_ROSHAN_KILL', 'CHAT_MESSAGE_AEGIS']
+
+
+def sample_analysis(moments, rng):
+    # Анализ в том виде, в каком его строит analyze_match
+    heroes = rng.sample(range(1, 130), 10)
+    return {
+        'draft_analysis': {
+            'radiant_heroes': heroes[:5],
+            'dire_heroes': heroes[5:],
+            'synergy_score': round(rng.uniform(40, 60), 2),
+            'dire_synergy_score': round(rng.uniform(40, 60), 2),
+            'counter_score': round(rng.uniform(40, 60), 2)
+        },
+        'key_moments': sorted(({
+            'time': rng.randint(0, 3600),
+            'type': rng.choice(MOMENT_TYPES),
+            'slot': rng.randint(0, 9),
+            'team': rng.randint(2, 3),
+            'unit': f"npc_dota_hero_{rng.randint(1, 129)}",
+            'key': f"npc_dota_goodguys_tower{rng.randint(1, 4)}_mid"
+        } for _ in range(moments)), key=lambda moment: moment['time']),
+        'performance_metrics': [{
+            'player_slot': slot,
+            'hero_id': hero,
+            'kills': rng.randint(0, 20),
+            'deaths': rng.randint(0, 15),
+            'assists': rng.randint(0, 30),
+            'gpm': rng.randint(200, 900),
+            'xpm': rng.randint(200, 1000),
+            'hero_damage': rng.randint(1000, 60000),
+            'tower_damage': rng.randint(0, 15000),
+            'hero_healing': rng.randint(0, 10000)
+        } for slot, hero in zip(list(range(5)) + list(range(128, 133)), heroes)]
+    }
+
+
+def bench(name, encode, decode, analyses, number=20):
+    blobs = [encode(analysis) for analysis in analyses]
+    size = sum(len(blob) for blob in blobs) / len(blobs)
+    encode_us = timeit.timeit(lambda: [encode(a) for a in analyses], number=number) / number / len(analyses) * 1e6
+    decode_us = timeit.timeit(lambda: [decode(b) for b in blobs], number=number) / number / len(blobs) * 1e6
+    print(f"{name:<10} {size:>10.0f} B {encode_us:>10.1f} us {decode_us:>10.1f} us")
+    return size
+
+
+def main():
+    moments = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rng = random.Random(42)
+    analyses = [sample_analysis(moments, rng) for _ in range(200)]
+    assert all(decode_analysis(encode_analysis(analysis)) == analysis for analysis in analyses)
+
+    print(f"{len(analyses)} analyses, {moments} key moments each")
+    print(f"{'format':<10} {'avg size':>12} {'encode':>13} {'decode':>13}")
+    json_size = bench('json', lambda a: json.dumps(a).encode(), json.loads, analyses)
+    compact_size = bench('compact', encode_analysis, decode_analysis, analyses)
+    print(f"compact is {json_size / compact_size:.1f}x smaller")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from jsonprovider import StdlibJSONProvider, json_provider_class, orjson
+from serializers import serialize_build, serialize_match_analysis
+
+# Время кодирования ответов: ручные словари + стандартный провайдер Flask (до)
+# против общих сериализаторов + StdlibJSONProvider / orjson (после).
+# Запуск: python benchmarks/json_encoding.py [число сборок]
+
+
+def sample_builds(count, rng):
+    started = datetime(2024, 1, 1)
+    return [SimpleNamespace(
+        id=i, hero_id=rng.randint(1, 129), name=f"Build {i}", description='Fast farm into late game ' * 3,
+        items=[f"item_{rng.randint(1, 300)}" for _ in range(12)],
+        skills=[rng.randint(1, 4) for _ in range(18)],
+        talents=['left', 'right', 'left', 'right'], playstyle='balanced', votes=rng.randint(0, 5000),
+        created_at=started + timedelta(minutes=i), updated_at=started + timedelta(days=1, minutes=i)
+    ) for i in range(count)]
+
+
+def sample_match(rng, moments=300):
+    return SimpleNamespace(
+        match_id=7000000000, radiant_win=True, duration=2400, created_at=datetime(2024, 1, 1),
+        updated_at=datetime(2024, 1, 2),
+        analysis={
+            'draft_analysis': {'radiant_heroes': [1, 2, 3, 4, 5], 'dire_heroes': [6, 7, 8, 9, 10],
+                               'synergy_score': 52.1, 'dire_synergy_score': 49.3, 'counter_score': 51.7},
+            'key_moments': [{'time': t * 8, 'type': 'building_kill', 'slot': t % 10, 'team': 2 + t % 2,
+                             'unit': 'npc_dota_hero_axe', 'key': 'npc_dota_badguys_tower1_mid'}
+                            for t in range(moments)],
+            'performance_metrics': [{'player_slot': slot, 'hero_id': slot + 1, 'kills': rng.randint(0, 20),
+                                     'deaths': rng.randint(0, 15), 'assists': rng.randint(0, 30),
+                                     'gpm': rng.randint(200, 900), 'xpm': rng.randint(200, 1000),
+                                     'hero_damage': rng.randint(1000, 60000),
+                                     'tower_damage': rng.randint(0, 15000),
+                                     'hero_healing': rng.randint(0, 10000)} for slot in range(10)]
+        }
+    )
+
+
+def build_by_hand(build):
+    # Так ответы собирались до общих сериализаторов
+    return {
+        'id': build.id, 'hero_id': build.hero_id, 'name': build.name, 'description': build.description,
+        'items': build.items, 'skills': build.skills, 'talents': build.talents, 'playstyle': build.playstyle,
+        'votes': build.votes, 'created_at': build.created_at.isoformat(),
+        'updated_at': build.updated_at.isoformat() if build.updated_at else None
+    }
+
+
+def match_by_hand(match):
+    return {'match_id': match.match_id, 'radiant_win': match.radiant_win, 'duration': match.duration,
+            'analysis': match.analysis, 'created_at': match.created_at.isoformat(),
+            'updated_at': match.updated_at.isoformat() if match.updated_at else None}
+
+
+def measure(label, fn, number, baseline=None):
+    seconds = timeit.timeit(fn, number=number) / number
+    speedup = f" {baseline / seconds:>6.1f}x" if baseline else ''
+    print(f"  {label:<28} {seconds * 1000:>8.3f} ms{speedup}")
+    return seconds
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rng = random.Random(7)
+    app = Flask(__name__)
+    builds, match = sample_builds(count, rng), sample_match(rng)
+
+    providers = [('flask default (before)', DefaultJSONProvider(app)), ('stdlib provider', StdlibJSONProvider(app))]
+    if orjson is not None:
+        providers.append(('orjson provider', json_provider_class('orjson')(app)))
+    else:
+        print("orjson is not installed, only stdlib providers are measured")
+
+    with app.app_context():
+        for title, before, after, number in (
+            (f"{count} builds", lambda: [build_by_hand(b) for b in builds],
+             lambda: [serialize_build(b) for b in builds], 20),
+            ('full match analysis', lambda: match_by_hand(match), lambda: serialize_match_analysis(match), 200)
+        ):
+            print(title)
+            baseline = measure(providers[0][0], lambda: providers[0][1].response(before()), number)
+            for label, provider in providers[1:]:
+                measure(label, lambda: provider.response(after()), number, baseline)
+
+
+if __name__ == '__main__':
+    main()
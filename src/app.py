@@ -1,60 +1,636 @@
 import os
+import atexit
+import base64
+import gzip
+import json
+import multiprocessing
+import threading
+import time
+import uuid
+import zlib
+import click
+import numpy as np
 import requests
-from flask import Flask, jsonify, request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from itertools import islice
+from flask import Flask, Response, abort, g, jsonify, request, stream_with_context, url_for
 from flask_cors import CORS
 from dotenv import load_dotenv
-from models import db, Hero, HeroCounter, HeroSynergy, HeroBuild, BuildComment, MatchAnalysis
-from sqlalchemy.exc import SQLAlchemyError
+from archive import MatchArchive, decode_record
+from models import db, Hero, HeroCounter, HeroSynergy, HeroBuild, BuildComment, MatchAnalysis, AnalysisJob, HeroPerformance, HeroPairStat
+from opendota import OpenDotaClient, ResponseCache, endpoint_class
+from matchups import MatchupMatrix, rank_candidates
+from metrics import (QUERY_COUNT_BUCKETS, MetricsRegistry, install_engine_events, start_db_tracking,
+                     stop_db_tracking)
+from migrations import migrate_schema
+from registry import HeroRegistry, record_etag
+from jsonprovider import json_provider_class
+from shared_cache import SharedCache
+from serializers import (serialize_build, serialize_comment, serialize_counter, serialize_hero,
+                         serialize_match_analysis)
+from rollups import (bucket_bounds, match_pairs, rebuild_hero_performance, snapshot, summarize,
+                     update_hero_performance, update_pair_stats)
+from singleflight import SingleFlight, acquire_lease, lease_flight, release_lease
+from timeline import build_moments_index, query_moments
+from votes import VoteAggregator
+from sqlalchemy import and_, bindparam, or_
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+try:
+    import brotli
+except ImportError:  # без brotli ответы сжимаются только gzip
+    brotli = None
 
 load_dotenv()
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///dota2.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['OPENDOTA_POOL_SIZE'] = int(os.getenv('OPENDOTA_POOL_SIZE', 10))
+app.config['OPENDOTA_CONNECT_TIMEOUT'] = float(os.getenv('OPENDOTA_CONNECT_TIMEOUT', 3.05))
+app.config['OPENDOTA_READ_TIMEOUT'] = float(os.getenv('OPENDOTA_READ_TIMEOUT', 10))
+app.config['OPENDOTA_MAX_RETRIES'] = int(os.getenv('OPENDOTA_MAX_RETRIES', 2))
+app.config['OPENDOTA_BACKOFF'] = float(os.getenv('OPENDOTA_BACKOFF', 0.5))
+app.config['OPENDOTA_CACHE_MAX_BYTES'] = int(os.getenv('OPENDOTA_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+app.config['OPENDOTA_NEGATIVE_TTL'] = int(os.getenv('OPENDOTA_NEGATIVE_TTL', 60))
+# Время жизни ответов по классам эндпоинтов (в секундах)
+app.config['OPENDOTA_CACHE_TTLS'] = {
+    'heroes': 24 * 60 * 60,
+    'heroes/{id}/matchups': 6 * 60 * 60,
+    'matches/{id}': 24 * 60 * 60
+}
+# Аренда на выборку из OpenDota при промахе (между процессами)
+app.config['FETCH_LEASE_TTL'] = int(os.getenv('FETCH_LEASE_TTL', 30))
+app.config['FETCH_LEASE_WAIT'] = int(os.getenv('FETCH_LEASE_WAIT', 30))
+# Через сколько секунд вычисленные контрпики считаются устаревшими и обновляются в фоне
+app.config['COUNTERS_MAX_AGE'] = int(os.getenv('COUNTERS_MAX_AGE', 24 * 60 * 60))
+app.config['COUNTERS_REFRESH_CONCURRENCY'] = int(os.getenv('COUNTERS_REFRESH_CONCURRENCY', 2))
+# Размер страницы для списков сборок и комментариев
+app.config['PAGE_DEFAULT_LIMIT'] = int(os.getenv('PAGE_DEFAULT_LIMIT', 50))
+app.config['PAGE_MAX_LIMIT'] = int(os.getenv('PAGE_MAX_LIMIT', 200))
+# Отложенная пакетная запись голосов (write-behind) вместо UPDATE на каждый голос
+app.config['VOTE_BATCHING'] = os.getenv('VOTE_BATCHING', '0') == '1'
+app.config['VOTE_FLUSH_INTERVAL_MS'] = int(os.getenv('VOTE_FLUSH_INTERVAL_MS', 50))
+# Матрица матчапов всех героев на диске и порог винрейта для контрпика
+app.config['MATCHUP_MATRIX_PATH'] = os.getenv('MATCHUP_MATRIX_PATH', os.path.join(app.instance_path, 'matchups.npy'))
+app.config['COUNTER_WIN_RATE_THRESHOLD'] = float(os.getenv('COUNTER_WIN_RATE_THRESHOLD', 53))
+# Матрица синергий (пары союзников), строится командой build-synergies
+app.config['SYNERGY_MATRIX_PATH'] = os.getenv('SYNERGY_MATRIX_PATH', os.path.join(app.instance_path, 'synergies.npy'))
+# Пакетный анализ матчей: максимум ID в запросе и параллельных запросов к OpenDota
+app.config['MATCH_BATCH_MAX'] = int(os.getenv('MATCH_BATCH_MAX', 500))
+app.config['MATCH_BATCH_WORKERS'] = int(os.getenv('MATCH_BATCH_WORKERS', 8))
+# Асинхронный анализ матчей: задания в БД, выборка и анализ в пуле процессов (0 - прямо в запросе)
+app.config['MATCH_ANALYSIS_ASYNC'] = os.getenv('MATCH_ANALYSIS_ASYNC', '0') == '1'
+app.config['JOB_WORKERS'] = int(os.getenv('JOB_WORKERS', os.cpu_count() or 1))
+app.config['JOB_MAX_WAIT'] = float(os.getenv('JOB_MAX_WAIT', 30))
+app.config['JOB_STALE_AFTER'] = int(os.getenv('JOB_STALE_AFTER', 10 * 60))
+# Архив сырых ответов OpenDota по матчам для повторного анализа без сети (пусто - не хранить)
+app.config['MATCH_ARCHIVE_DIR'] = os.getenv('MATCH_ARCHIVE_DIR', os.path.join(app.instance_path, 'match_archive'))
+# Формат хранения анализа матчей: json или compact (колонки + zlib с общим словарем)
+app.config['ANALYSIS_STORAGE'] = os.getenv('ANALYSIS_STORAGE', 'json')
+# Откуда брать матчапы и синергии: opendota (матрицы по данным OpenDota) или local
+# (пары героев из сохраненных у нас матчей, без запросов к OpenDota)
+app.config['PAIR_STATS_SOURCE'] = os.getenv('PAIR_STATS_SOURCE', 'opendota')
+# JSON-провайдер ответов: auto (orjson, если установлен), orjson или stdlib
+app.config['JSON_PROVIDER'] = os.getenv('JSON_PROVIDER', 'auto')
+# Сжатие ответов (gzip, brotli при наличии пакета) начиная с COMPRESS_MIN_SIZE байт
+app.config['COMPRESS_MIN_SIZE'] = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+app.config['COMPRESS_LEVEL'] = int(os.getenv('COMPRESS_LEVEL', 6))
+# Общий для воркеров на хосте кэш справочника героев и контрпиков (пусто - только память процесса);
+# на Linux каталог можно вынести в /dev/shm
+app.config['SHARED_CACHE_DIR'] = os.getenv('SHARED_CACHE_DIR', os.path.join(app.instance_path, 'shared_cache'))
+# Метрики запросов, SQL и OpenDota для GET /metrics (формат Prometheus)
+app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED', '1') == '1'
+
+app.json_provider_class = json_provider_class(app.config['JSON_PROVIDER'])
+app.json = app.json_provider_class(app)
 
 CORS(app)
 db.init_app(app)
+MatchAnalysis.storage = app.config['ANALYSIS_STORAGE']
 
 OPENDOTA_URL = "https://api.opendota.com/api"
 
+# Один клиент на процесс: его делят calculate_counters, get_match_analysis и init-db
+opendota = OpenDotaClient(
+    OPENDOTA_URL,
+    pool_size=app.config['OPENDOTA_POOL_SIZE'],
+    connect_timeout=app.config['OPENDOTA_CONNECT_TIMEOUT'],
+    read_timeout=app.config['OPENDOTA_READ_TIMEOUT'],
+    max_retries=app.config['OPENDOTA_MAX_RETRIES'],
+    backoff=app.config['OPENDOTA_BACKOFF'],
+    cache=ResponseCache(
+        max_bytes=app.config['OPENDOTA_CACHE_MAX_BYTES'],
+        ttls=app.config['OPENDOTA_CACHE_TTLS'],
+        negative_ttl=app.config['OPENDOTA_NEGATIVE_TTL']
+    )
+)
+
+# Справочник героев меняется раз в патч, поэтому держим его в памяти процесса;
+# версию сверяем с общим кэшем, чтобы сброс в одном воркере видели все
+hero_registry = HeroRegistry(shared=lambda: get_shared_cache())
+
+# Матчапы всех пар героев; сохраненная матрица подхватывается при старте
+def load_pair_matrix(path):
+    return MatchupMatrix.load(path) if os.path.exists(path) else MatchupMatrix()
+
+
+matchup_matrix = load_pair_matrix(app.config['MATCHUP_MATRIX_PATH'])
+synergy_matrix = load_pair_matrix(app.config['SYNERGY_MATRIX_PATH'])
+
+# Матрицы по собственным матчам (hero_pair_stats) грузятся из БД при первом обращении
+# и перечитываются, когда другой воркер записал новые матчи (версия PAIR_STATS_KEY в общем кэше)
+PAIR_STATS_KEY = 'pair_stats'
+_local_pairs = None
+_local_pairs_version = None
+_local_pairs_lock = threading.Lock()
+
+# Одновременные промахи по одному матчу или герою превращаются в один запрос к OpenDota
+inflight = SingleFlight(timeout=app.config['FETCH_LEASE_WAIT'])
+
+# Маркер "матча нет в OpenDota" для single-flight
+MATCH_NOT_FOUND = {}
+
+# Фоновое обновление устаревших контрпиков (stale-while-revalidate)
+counter_refresh_pool = ThreadPoolExecutor(
+    max_workers=app.config['COUNTERS_REFRESH_CONCURRENCY'],
+    thread_name_prefix='counter-refresh'
+)
+_refreshing_heroes = set()
+_refreshing_lock = threading.Lock()
+
+
+def flush_votes(batch):
+    # Один executemany UPDATE с атомарным инкрементом на всю пачку голосов
+    builds = HeroBuild.__table__
+    with app.app_context():
+        db.session.execute(
+            builds.update()
+            .where(builds.c.id == bindparam('build_id'))
+            .values(votes=builds.c.votes + bindparam('delta')),
+            [{'build_id': build_id, 'delta': delta} for build_id, delta in batch.items()]
+        )
+        db.session.commit()
+
+
+# Пул процессов для заданий анализа создается при первом задании
+_job_pool = None
+_job_pool_lock = threading.Lock()
+
+# Архив матчей открывается при первом обращении
+_match_archive = None
+_match_archive_lock = threading.Lock()
+
+# Общий кэш воркеров открывается при первом обращении
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+vote_aggregator = VoteAggregator(flush_votes, interval=app.config['VOTE_FLUSH_INTERVAL_MS'] / 1000)
+atexit.register(vote_aggregator.stop)
+
+# Метрики процесса: каждый воркер отдает свои, агрегирует Prometheus
+metrics = MetricsRegistry()
+http_requests = metrics.counter('http_requests_total', 'HTTP requests by route and status',
+                                ('method', 'route', 'status'))
+http_latency = metrics.histogram('http_request_duration_seconds', 'HTTP request latency',
+                                 ('method', 'route'))
+http_db_queries = metrics.histogram('http_request_db_queries', 'SQL statements executed per HTTP request',
+                                    ('method', 'route'), buckets=QUERY_COUNT_BUCKETS)
+http_db_time = metrics.histogram('http_request_db_seconds', 'Time spent in SQL per HTTP request',
+                                 ('method', 'route'))
+opendota_requests = metrics.counter('opendota_requests_total', 'OpenDota fetches by endpoint class and outcome',
+                                    ('endpoint', 'outcome'))
+opendota_latency = metrics.histogram('opendota_request_duration_seconds',
+                                     'OpenDota fetch latency including cache and retries', ('endpoint',))
+install_engine_events()
+
+
+@app.before_request
+def start_request_metrics():
+    if app.config['METRICS_ENABLED']:
+        g.metrics_started = time.perf_counter()
+        g.db_usage = start_db_tracking()
+
+
+@app.after_request
+def record_request_metrics(response):
+    # Регистрируется раньше compress_response, поэтому выполняется после него и учитывает сжатие.
+    # У потоковых ответов учитывается время до начала отдачи тела
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    labels = (request.method, route)
+    http_requests.inc((request.method, route, str(response.status_code)))
+    http_latency.observe(labels, time.perf_counter() - started)
+    queries, seconds = g.db_usage
+    stop_db_tracking()
+    http_db_queries.observe(labels, queries)
+    http_db_time.observe(labels, seconds)
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    # gzip/brotli по Accept-Encoding для больших JSON-ответов; потоковые ответы (NDJSON) не трогаем
+    if (response.status_code < 200 or response.status_code in (204, 304) or response.is_streamed
+            or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or response.mimetype not in ('application/json', 'text/plain')):
+        return response
+    response.vary.add('Accept-Encoding')
+
+    body = response.get_data()
+    if len(body) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    if encoding is None:
+        return response
+
+    if encoding == 'br':
+        body = brotli.compress(body, quality=min(app.config['COMPRESS_LEVEL'], 11))
+    else:
+        body = gzip.compress(body, compresslevel=app.config['COMPRESS_LEVEL'], mtime=0)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        # У сжатого представления свой строгий ETag
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
 
 # Вспомогательные функции
+def get_hero_or_404(hero_id):
+    # Герой из реестра без запроса к БД
+    hero = hero_registry.get(hero_id)
+    if hero is None:
+        abort(404)
+    return hero
+
+
+def hero_localized_name(hero_id):
+    hero = hero_registry.get(hero_id)
+    return hero.localized_name if hero else None
+
+
+def single_flight(key, lookup, produce):
+    # Первый запрос выполняет produce, остальные в этом и других процессах ждут его результат
+    return inflight.do(key, lambda: lease_flight(
+        key, lookup, produce,
+        ttl=app.config['FETCH_LEASE_TTL'],
+        wait=app.config['FETCH_LEASE_WAIT']
+    ))
+
+
+def schedule_counter_refresh(hero_id):
+    # Ставим обновление в очередь, если для героя оно еще не запланировано
+    with _refreshing_lock:
+        if hero_id in _refreshing_heroes:
+            return False
+        _refreshing_heroes.add(hero_id)
+    counter_refresh_pool.submit(_run_counter_refresh, hero_id)
+    return True
+
+
+def _run_counter_refresh(hero_id):
+    try:
+        with app.app_context():
+            refresh_hero_counters(hero_id)
+    except Exception as e:
+        app.logger.error(f"Error refreshing counters for hero {hero_id}: {e}")
+    finally:
+        with _refreshing_lock:
+            _refreshing_heroes.discard(hero_id)
+
+
+def refresh_hero_counters(hero_id):
+    # Пересчитать computed-контрпики героя; ручные правки не трогаем
+    key = f"refresh/counters/{hero_id}"
+    owner = acquire_lease(key, app.config['FETCH_LEASE_TTL'])
+    if owner is None:
+        return False  # обновлением уже занимается другой процесс
+
+    try:
+        counters_data = calculate_counters(hero_id, refresh=True)
+        if not counters_data:
+            return False  # OpenDota недоступна - оставляем старые данные
+        write_counter_batch([(hero_id, counters_data)])
+        return True
+    finally:
+        release_lease(key, owner)
+
+
+def write_counter_batch(batch):
+    # Заменить computed-контрпики пачки героев одной вставкой; batch - список (hero_id, counters_data)
+    hero_ids = [hero_id for hero_id, _ in batch]
+    try:
+        manual = set(db.session.execute(
+            db.select(HeroCounter.hero_id, HeroCounter.counter_hero_id)
+            .where(HeroCounter.hero_id.in_(hero_ids), HeroCounter.source == 'manual')
+        ).tuples())
+        db.session.execute(
+            db.delete(HeroCounter).where(HeroCounter.hero_id.in_(hero_ids), HeroCounter.source == 'computed')
+        )
+        rows = []
+        for hero_id, counters_data in batch:
+            exclude = {counter_hero_id for manual_hero_id, counter_hero_id in manual if manual_hero_id == hero_id}
+            rows.extend(computed_counter_rows(hero_id, counters_data, exclude=exclude))
+        if rows:
+            db.session.execute(db.insert(HeroCounter), rows)
+        db.session.commit()
+        invalidate_counters(hero_ids)
+        return len(rows)
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+
+
+def computed_counter_rows(hero_id, counters_data, exclude=()):
+    # Строки для пачечной вставки контрпиков, рассчитанных по OpenDota
+    fetched_at = datetime.utcnow()
+    return [{
+        'hero_id': hero_id,
+        'counter_hero_id': counter_data['hero_id'],
+        'win_rate': counter_data['win_rate'],
+        'reason': counter_data.get('reason', ''),
+        'source': 'computed',
+        'fetched_at': fetched_at
+    } for counter_data in counters_data if counter_data['hero_id'] not in exclude]
+
+
+def encode_cursor(values):
+    # Непрозрачный курсор страницы: ключ последней строки в base64
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        values = None
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def page_params():
+    # limit и курсор из query string; limit ограничен сверху на сервере
+    limit = request.args.get('limit', app.config['PAGE_DEFAULT_LIMIT'], type=int)
+    limit = max(1, min(limit, app.config['PAGE_MAX_LIMIT']))
+    cursor = request.args.get('cursor')
+    return limit, decode_cursor(cursor) if cursor else None
+
+
+def paginated_response(items, limit, cursor_key):
+    # Выбираем limit + 1 строк: лишняя строка означает, что есть следующая страница
+    response = jsonify(items[:limit])
+    if len(items) > limit:
+        response.headers['X-Next-Cursor'] = encode_cursor(cursor_key(items[limit - 1]))
+    return response
+
+
+def version_etag(kind, object_id, version, variant=''):
+    # Строгий ETag по времени последнего изменения объекта (с точностью до микросекунды)
+    stamp = (version - datetime(1970, 1, 1)) // timedelta(microseconds=1)
+    return f"{kind}-{object_id}-{stamp}" + (f"-{variant}" if variant else '')
+
+
+def not_modified(etag, last_modified=None):
+    # Ранний 304 по If-None-Match / If-Modified-Since, до загрузки самого объекта.
+    # Сжатые варианты ответа имеют ETag с суффиксом кодировки
+    if request.if_none_match:
+        matched = any(request.if_none_match.contains(tag) for tag in (etag, f"{etag}-gzip", f"{etag}-br"))
+    elif last_modified is not None and request.if_modified_since is not None:
+        matched = http_time(last_modified) <= request.if_modified_since
+    else:
+        matched = False
+    return with_validators(Response(status=304), etag, last_modified) if matched else None
+
+
+def with_validators(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = http_time(last_modified)
+    return response
+
+
+def http_time(value):
+    # Время из БД (naive UTC) с точностью HTTP-дат
+    return value.replace(tzinfo=timezone.utc, microsecond=0)
+
+
+def increment_votes(build_id, delta):
+    # UPDATE votes = votes + delta; новое значение через RETURNING, если диалект умеет
+    statement = db.update(HeroBuild).where(HeroBuild.id == build_id).values(votes=HeroBuild.votes + delta)
+    if db.engine.dialect.update_returning:
+        return db.session.execute(statement.returning(HeroBuild.votes)).scalar_one_or_none()
+    if db.session.execute(statement).rowcount == 0:
+        return None
+    return db.session.execute(db.select(HeroBuild.votes).where(HeroBuild.id == build_id)).scalar_one()
+
+
 def fetch_opendota_data(endpoint):
-    # Получение данных из опендоты
+    # Получение данных из опендоты (через кэш ответов)
+    started = time.perf_counter()
+    outcome = 'ok'
     try:
-        response = requests.get(f"{OPENDOTA_URL}/{endpoint}")
-        response.raise_for_status()
-        return response.json()
+        data = opendota.fetch(endpoint)
+        if data is None:
+            outcome = 'not_found'
+        return data
     except requests.RequestException as e:
+        outcome = 'error'
         app.logger.error(f"Error fetching data from OpenDota: {e}")
         return None
+    finally:
+        if app.config['METRICS_ENABLED']:
+            key = endpoint_class(endpoint)
+            opendota_requests.inc((key, outcome))
+            opendota_latency.observe((key,), time.perf_counter() - started)
 
 
-def calculate_counters(hero_id):
-    # Расчет контрпиков для героя на основе данных опендоты
-    data = fetch_opendota_data(f"heroes/{hero_id}/matchups")
-    if not data:
-        return []
-
-    counters = []
-    for matchup in data:
-        counter_hero_id = matchup['hero_id']
-        games = matchup['games_played']
-        wins = matchup['wins']
+def get_match_archive():
+    global _match_archive
+    directory = app.config['MATCH_ARCHIVE_DIR']
+    if not directory:
+        return None
+    with _match_archive_lock:
+        if _match_archive is None or _match_archive.directory != directory:
+            _match_archive = MatchArchive(directory)
+        return _match_archive
 
-        if games > 0:
-            win_rate = (wins / games) * 100
-            # Если винрейт больше 53%, будем считать это контрпиком
-            if win_rate > 53:
-                counter_hero = Hero.query.get(counter_hero_id)
-                if counter_hero:
-                    counters.append({
-                        'hero_id': counter_hero_id,
-                        'win_rate': round(win_rate, 2),
-                        'reason': f"High win rate of {round(win_rate, 2)}% in {games} matches"
-                    })
 
-    return counters
+def get_shared_cache():
+    global _shared_cache
+    directory = app.config['SHARED_CACHE_DIR']
+    if not directory:
+        return None
+    cache = _shared_cache
+    if cache is not None and cache.directory == directory:
+        return cache
+    with _shared_cache_lock:
+        if _shared_cache is None or _shared_cache.directory != directory:
+            _shared_cache = SharedCache(directory, dumps=app.json.dumps)
+        return _shared_cache
+
+
+def invalidate_counters(hero_ids):
+    # Вызывается после коммита: другие воркеры перестанут отдавать закэшированные контрпики
+    shared = get_shared_cache()
+    if shared is not None:
+        for hero_id in set(hero_ids):
+            shared.bump(f"counters/{hero_id}")
+
+
+def load_match_data(match_id):
+    # Сырые данные матча: из архива, иначе из OpenDota с сохранением в архив
+    archive = get_match_archive()
+    if archive is not None:
+        match_data = archive.get(match_id)
+        if match_data is not None:
+            return match_data
+
+    match_data = fetch_opendota_data(f"matches/{match_id}")
+    if match_data and archive is not None:
+        try:
+            archive.append(match_id, match_data)
+        except OSError as e:
+            app.logger.warning(f"Failed to archive match {match_id}: {e}")
+    return match_data
+
+
+def get_local_pair_matrices():
+    # (синергии, матчапы) по hero_pair_stats
+    global _local_pairs, _local_pairs_version
+    shared = get_shared_cache()
+    version = shared.version(PAIR_STATS_KEY) if shared is not None else None
+    local = _local_pairs
+    if local is not None and _local_pairs_version == version:
+        return local
+    with _local_pairs_lock:
+        if _local_pairs is None or _local_pairs_version != version:
+            synergies, matchups = MatchupMatrix(), MatchupMatrix()
+            rows = db.session.execute(db.select(
+                HeroPairStat.hero_id, HeroPairStat.other_hero_id, HeroPairStat.relation,
+                HeroPairStat.games, HeroPairStat.wins
+            )).all()
+            for relation, matrix in (('ally', synergies), ('enemy', matchups)):
+                pairs = [row for row in rows if row.relation == relation]
+                matrix.add_pairs([row.hero_id for row in pairs], [row.other_hero_id for row in pairs],
+                                 [row.games for row in pairs], [row.wins for row in pairs],
+                                 opposed=relation == 'enemy')
+            _local_pairs, _local_pairs_version = (synergies, matchups), version
+        return _local_pairs
+
+
+def reset_local_pair_matrices():
+    global _local_pairs, _local_pairs_version
+    with _local_pairs_lock:
+        _local_pairs = _local_pairs_version = None
+
+
+def pair_matrices():
+    # (синергии, матчапы) из источника PAIR_STATS_SOURCE
+    if app.config['PAIR_STATS_SOURCE'] == 'local':
+        return get_local_pair_matrices()
+    return synergy_matrix, matchup_matrix
+
+
+def record_match_pairs(matches):
+    # Пары героев новых матчей в hero_pair_stats (в текущей транзакции).
+    # matches - (radiant, dire, radiant_win); возвращает строки для apply_local_pairs
+    rows = [row for radiant, dire, radiant_win in matches for row in match_pairs(radiant, dire, radiant_win)]
+    update_pair_stats(rows)
+    return rows
+
+
+def remove_match_pairs(analysis):
+    # Вычесть пары удаляемого матча из hero_pair_stats (в текущей транзакции).
+    # Составы - из архива (по ним пары и записывались), иначе из сохраненного драфта;
+    # возвращает строки с отрицательными счетчиками для apply_local_pairs
+    archive = get_match_archive()
+    match_data = archive.get(analysis.match_id) if archive is not None else None
+    if match_data is not None:
+        radiant, dire = draft_teams(match_data)
+        radiant_win = match_data.get('radiant_win')
+    else:
+        draft = (analysis.analysis or {}).get('draft_analysis') or {}
+        radiant, dire = draft.get('radiant_heroes') or [], draft.get('dire_heroes') or []
+        radiant_win = analysis.radiant_win
+    rows = [dict(row, games=-row['games'], wins=-row['wins']) for row in match_pairs(radiant, dire, radiant_win)]
+    update_pair_stats(rows)
+    return rows
+
+
+def apply_local_pairs(rows):
+    # После коммита: новая версия пар в общем кэше, чтобы остальные воркеры перечитали матрицы.
+    # Свои пары дописываем в память, только если после нашей загрузки никто другой
+    # матчи не записывал - иначе матрицы перечитаются при следующем обращении
+    global _local_pairs_version
+    if not rows:
+        return
+    shared = get_shared_cache()
+    with _local_pairs_lock:
+        local = _local_pairs
+        if shared is not None:
+            version = shared.bump(PAIR_STATS_KEY)
+            if local is None or _local_pairs_version != (version[0], version[1] - 1):
+                return
+            _local_pairs_version = version
+        elif local is None:
+            return
+        apply_pair_rows(local, rows)
+
+
+def apply_pair_rows(local, rows):
+    for relation, matrix in zip(('ally', 'enemy'), local):
+        pairs = [row for row in rows if row['relation'] == relation]
+        matrix.add_pairs([row['hero_id'] for row in pairs], [row['other_hero_id'] for row in pairs],
+                         [row['games'] for row in pairs], [row['wins'] for row in pairs],
+                         opposed=relation == 'enemy')
+
+
+def calculate_counters(hero_id, refresh=False):
+    # Контрпики героя - срез матрицы матчапов; в OpenDota идем, только если строки героя нет
+    # (или при refresh=True, когда данные нужно обновить)
+    threshold = app.config['COUNTER_WIN_RATE_THRESHOLD']
+    if app.config['PAIR_STATS_SOURCE'] == 'local':
+        # Только свои матчи: без данных по герою контрпиков просто нет
+        matchups = get_local_pair_matrices()[1].counters_for(hero_id, threshold) or []
+    else:
+        matchups = None if refresh else matchup_matrix.counters_for(hero_id, threshold)
+    if matchups is None:
+        data = fetch_opendota_data(f"heroes/{hero_id}/matchups")
+        if not data:
+            return []
+        matchup_matrix.set_row(hero_id, data)
+        matchups = matchup_matrix.counters_for(hero_id, threshold)
+
+    # Если винрейт больше порога (по умолчанию 53%), будем считать это контрпиком
+    return [{
+        'hero_id': matchup['hero_id'],
+        'win_rate': matchup['win_rate'],
+        'reason': f"High win rate of {matchup['win_rate']}% in {matchup['games']} matches "
+                  f"(95% CI {matchup['ci_low']}-{matchup['ci_high']}%)"
+    } for matchup in matchups if hero_registry.get(matchup['hero_id'])]
+
+
+# Метрики для Prometheus
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Метрики процесса в текстовом формате Prometheus
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+    return Response(metrics.render(), content_type=metrics.content_type)
+
+
+# Статистика обращений к OpenDota
+@app.route('/api/opendota/stats', methods=['GET'])
+def get_opendota_stats():
+    # Задержки и ошибки по классам эндпоинтов
+    return jsonify(opendota.stats())
 
 
 # Роуты для героев
@@ -62,15 +638,12 @@ def calculate_counters(hero_id):
 def get_heroes():
     # Получить всех героев
     try:
-        heroes = Hero.query.all()
-        return jsonify([{
-            'id': hero.id,
-            'name': hero.name,
-            'localized_name': hero.localized_name,
-            'primary_attr': hero.primary_attr,
-            'attack_type': hero.attack_type,
-            'roles': hero.roles
-        } for hero in heroes])
+        etag = f"heroes-{hero_registry.etag()}"
+        last_modified = hero_registry.last_modified()
+        response = not_modified(etag, last_modified)
+        if response is not None:
+            return response
+        return with_validators(jsonify([serialize_hero(hero) for hero in hero_registry.all()]), etag, last_modified)
     except SQLAlchemyError as e:
         app.logger.error(f"Database error: {e}")
         return jsonify({'error': 'Internal server error'}), 500
@@ -80,15 +653,37 @@ def get_heroes():
 def get_hero(hero_id):
     # Получить героя по ID
     try:
-        hero = Hero.query.get_or_404(hero_id)
-        return jsonify({
-            'id': hero.id,
-            'name': hero.name,
-            'localized_name': hero.localized_name,
-            'primary_attr': hero.primary_attr,
-            'attack_type': hero.attack_type,
-            'roles': hero.roles
-        })
+        hero = get_hero_or_404(hero_id)
+        etag = f"hero-{hero_id}-{record_etag(hero)}"
+        response = not_modified(etag, hero.updated_at)
+        if response is not None:
+            return response
+        return with_validators(jsonify(serialize_hero(hero)), etag, hero.updated_at)
+    except SQLAlchemyError as e:
+        app.logger.error(f"Database error: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+
+@app.route('/api/heroes/<int:hero_id>/stats', methods=['GET'])
+def get_hero_stats(hero_id):
+    # Средние метрики героя по сохраненным матчам: всего и по длительности матча
+    try:
+        get_hero_or_404(hero_id)
+        rows = db.session.execute(
+            db.select(HeroPerformance).where(HeroPerformance.hero_id == hero_id)
+            .order_by(HeroPerformance.duration_bucket)
+        ).scalars().all()
+
+        rows = [row for row in rows if row.matches > 0]
+        overall = next((row for row in rows if row.duration_bucket == -1), None)
+        result = {'hero_id': hero_id, **(summarize(overall) if overall else {'matches': 0, 'metrics': {}})}
+        result['by_duration'] = []
+        for row in rows:
+            if row.duration_bucket == -1:
+                continue
+            low, high = bucket_bounds(row.duration_bucket)
+            result['by_duration'].append({'min_minutes': low, 'max_minutes': high, **summarize(row)})
+        return jsonify(result)
     except SQLAlchemyError as e:
         app.logger.error(f"Database error: {e}")
         return jsonify({'error': 'Internal server error'}), 500
@@ -99,31 +694,65 @@ def get_hero_counters(hero_id):
     # Получить контрпики для героя
     try:
         # Проверяем существование героя
-        Hero.query.get_or_404(hero_id)
-
-        counters = HeroCounter.query.filter_by(hero_id=hero_id).all()
-
-        # Если данных нет в базе, получаем из OpenDota
-        if not counters:
+        get_hero_or_404(hero_id)
+
+        # Только нужные колонки, без загрузки объектов в identity map
+        columns = (HeroCounter.id, HeroCounter.hero_id, HeroCounter.counter_hero_id, HeroCounter.win_rate,
+                   HeroCounter.reason, HeroCounter.source, HeroCounter.fetched_at)
+
+        def serialize(counters):
+            return [serialize_counter(counter, hero_localized_name(counter.counter_hero_id)) for counter in counters]
+
+        shared = get_shared_cache()
+        cache_key = f"counters/{hero_id}"
+
+        def lookup():
+            # Сначала общий кэш воркеров: сверка версии без запроса к БД
+            if shared is not None:
+                cached = shared.get(cache_key)
+                if cached is not None:
+                    if cached['refresh_after'] is not None and time.time() >= cached['refresh_after']:
+                        schedule_counter_refresh(hero_id)
+                    return cached['counters']
+                version = shared.version(cache_key)
+
+            counters = db.session.execute(db.select(*columns).where(HeroCounter.hero_id == hero_id)).all()
+            if not counters:
+                return None
+
+            # Устаревшие данные отдаем сразу, а обновляем в фоне
+            max_age = app.config['COUNTERS_MAX_AGE']
+            computed = [counter.fetched_at for counter in counters if counter.source == 'computed']
+            refresh_after = None
+            if computed:
+                refresh_after = 0 if None in computed else min(computed).replace(tzinfo=timezone.utc).timestamp() + max_age
+                if time.time() >= refresh_after:
+                    schedule_counter_refresh(hero_id)
+
+            result = serialize(counters)
+            if shared is not None:
+                shared.put(cache_key, {'counters': result, 'refresh_after': refresh_after}, version)
+            return result
+
+        def produce():
+            # Если данных нет в базе, получаем из OpenDota
+            counters = []
             counters_data = calculate_counters(hero_id)
-            for counter_data in counters_data:
-                counter = HeroCounter(
-                    hero_id=hero_id,
-                    counter_hero_id=counter_data['hero_id'],
-                    win_rate=counter_data['win_rate'],
-                    reason=counter_data.get('reason', '')
-                )
-                db.session.add(counter)
+            if counters_data:
+                # Одна пачечная вставка, RETURNING отдает строки для ответа без повторного запроса
+                counters = db.session.execute(
+                    db.insert(HeroCounter).returning(*columns),
+                    computed_counter_rows(hero_id, counters_data)
+                ).all()
             db.session.commit()
-            counters = HeroCounter.query.filter_by(hero_id=hero_id).all()
-
-        return jsonify([{
-            'id': counter.id,
-            'counter_hero_id': counter.counter_hero_id,
-            'counter_hero_name': counter.counter_hero.localized_name,
-            'win_rate': counter.win_rate,
-            'reason': counter.reason
-        } for counter in counters])
+            invalidate_counters([hero_id])
+            return serialize(counters)
+
+        counters = lookup()
+        if counters is None:
+            counters = single_flight(cache_key, lookup, produce)
+
+        return jsonify(counters)
     except SQLAlchemyError as e:
         app.logger.error(f"Database error: {e}")
         return jsonify({'error': 'Internal server error'}), 500
@@ -133,31 +762,34 @@ def get_hero_counters(hero_id):
 def add_hero_counter(hero_id):
     # Добавить контрпик для героя
     try:
-        Hero.query.get_or_404(hero_id)
+        get_hero_or_404(hero_id)
 
         data = request.get_json()
-        if not data or 'counter_hero_id' not in data: # Проверяем существование героя-контрпика
+        if not isinstance(data, dict) or 'counter_hero_id' not in data: # Проверяем существование героя-контрпика
             return jsonify({'error': 'counter_hero_id is required'}), 400
+        try:
+            counter_hero_id = int(data['counter_hero_id'])
+        except (TypeError, ValueError):
+            return jsonify({'error': 'counter_hero_id must be an integer'}), 400
 
-        Hero.query.get_or_404(data['counter_hero_id'])
+        get_hero_or_404(counter_hero_id)
 
-        counter = HeroCounter(
-            hero_id=hero_id,
-            counter_hero_id=data['counter_hero_id'],
-            win_rate=data.get('win_rate'),
-            reason=data.get('reason', '')
-        )
+        # Пара (герой, контрпик) уникальна: повторный POST перезаписывает существующую запись
+        counter = HeroCounter.query.filter_by(hero_id=hero_id, counter_hero_id=counter_hero_id).first()
+        if counter is None:
+            counter = HeroCounter(hero_id=hero_id, counter_hero_id=counter_hero_id)
+            db.session.add(counter)
+        counter.win_rate = data.get('win_rate')
+        counter.reason = data.get('reason', '')
+        counter.source = 'manual'
 
-        db.session.add(counter)
         db.session.commit()
+        invalidate_counters([hero_id])
 
-        return jsonify({
-            'id': counter.id,
-            'hero_id': counter.hero_id,
-            'counter_hero_id': counter.counter_hero_id,
-            'win_rate': counter.win_rate,
-            'reason': counter.reason
-        }), 201
+        return jsonify(serialize_counter(counter, hero_localized_name(counter.counter_hero_id))), 201
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'Counter already exists'}), 409
     except SQLAlchemyError as e:
         db.session.rollback()
         app.logger.error(f"Database error: {e}")
@@ -175,16 +807,13 @@ def update_hero_counter(hero_id, counter_id):
             counter.win_rate = data['win_rate']
         if 'reason' in data:
             counter.reason = data['reason']
+        # Отредактированный вручную контрпик больше не перезаписывается фоновым обновлением
+        counter.source = 'manual'
 
         db.session.commit()
+        invalidate_counters([hero_id])
 
-        return jsonify({
-            'id': counter.id,
-            'hero_id': counter.hero_id,
-            'counter_hero_id': counter.counter_hero_id,
-            'win_rate': counter.win_rate,
-            'reason': counter.reason
-        })
+        return jsonify(serialize_counter(counter, hero_localized_name(counter.counter_hero_id)))
     except SQLAlchemyError as e:
         db.session.rollback()
         app.logger.error(f"Database error: {e}")
@@ -199,6 +828,7 @@ def delete_hero_counter(hero_id, counter_id):
 
         db.session.delete(counter)
         db.session.commit()
+        invalidate_counters([hero_id])
 
         return jsonify({'message': 'Counter deleted successfully'}), 200
     except SQLAlchemyError as e:
@@ -212,22 +842,32 @@ def delete_hero_counter(hero_id, counter_id):
 def get_hero_builds(hero_id):
     # Получить сборки для героя
     try:
-        Hero.query.get_or_404(hero_id)
-
-        builds = HeroBuild.query.filter_by(hero_id=hero_id).all()
-
-        return jsonify([{
-            'id': build.id,
-            'hero_id': build.hero_id,
-            'name': build.name,
-            'description': build.description,
-            'items': build.items,
-            'skills': build.skills,
-            'talents': build.talents,
-            'playstyle': build.playstyle,
-            'votes': build.votes,
-            'created_at': build.created_at.isoformat()
-        } for build in builds])
+        get_hero_or_404(hero_id)
+
+        try:
+            limit, cursor = page_params()
+            # Курсор приходит от клиента: votes и id должны быть целыми
+            if cursor and not all(type(value) is int for value in cursor):
+                raise ValueError('Invalid cursor')
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+        # Keyset-пагинация по (votes, id): глубина страницы не влияет на стоимость запроса
+        query = (
+            db.select(HeroBuild.id, HeroBuild.hero_id, HeroBuild.name, HeroBuild.description,
+                      HeroBuild.items, HeroBuild.skills, HeroBuild.talents, HeroBuild.playstyle,
+                      HeroBuild.votes, HeroBuild.created_at, HeroBuild.updated_at)
+            .where(HeroBuild.hero_id == hero_id)
+            .order_by(HeroBuild.votes.desc(), HeroBuild.id.desc())
+            .limit(limit + 1)
+        )
+        if cursor:
+            votes, last_id = cursor
+            query = query.where(or_(HeroBuild.votes < votes, and_(HeroBuild.votes == votes, HeroBuild.id < last_id)))
+        builds = db.session.execute(query).all()
+
+        return paginated_response([serialize_build(build) for build in builds], limit,
+                                  lambda build: [build['votes'], build['id']])
     except SQLAlchemyError as e:
         app.logger.error(f"Database error: {e}")
         return jsonify({'error': 'Internal server error'}), 500
@@ -237,7 +877,7 @@ def get_hero_builds(hero_id):
 def create_hero_build(hero_id):
     # Создать сборку для героя
     try:
-        Hero.query.get_or_404(hero_id)
+        get_hero_or_404(hero_id)
 
         data = request.get_json()
         if not data or 'name' not in data or 'items' not in data or 'skills' not in data:
@@ -257,18 +897,7 @@ def create_hero_build(hero_id):
         db.session.add(build)
         db.session.commit()
 
-        return jsonify({
-            'id': build.id,
-            'hero_id': build.hero_id,
-            'name': build.name,
-            'description': build.description,
-            'items': build.items,
-            'skills': build.skills,
-            'talents': build.talents,
-            'playstyle': build.playstyle,
-            'votes': build.votes,
-            'created_at': build.created_at.isoformat()
-        }), 201
+        return jsonify(serialize_build(build)), 201
     except SQLAlchemyError as e:
         db.session.rollback()
         app.logger.error(f"Database error: {e}")
@@ -279,21 +908,19 @@ def create_hero_build(hero_id):
 def get_build(build_id):
     # Получить сборку по ID
     try:
-        build = HeroBuild.query.get_or_404(build_id)
+        # Сначала только время изменения: если у клиента актуальная версия - 304 без загрузки сборки
+        version = db.session.execute(
+            db.select(db.func.coalesce(HeroBuild.updated_at, HeroBuild.created_at)).where(HeroBuild.id == build_id)
+        ).first()
+        if version is None:
+            abort(404)
+        etag = version_etag('build', build_id, version[0])
+        response = not_modified(etag, version[0])
+        if response is not None:
+            return response
 
-        return jsonify({
-            'id': build.id,
-            'hero_id': build.hero_id,
-            'name': build.name,
-            'description': build.description,
-            'items': build.items,
-            'skills': build.skills,
-            'talents': build.talents,
-            'playstyle': build.playstyle,
-            'votes': build.votes,
-            'created_at': build.created_at.isoformat(),
-            'updated_at': build.updated_at.isoformat() if build.updated_at else None
-        })
+        build = HeroBuild.query.get_or_404(build_id)
+        return with_validators(jsonify(serialize_build(build)), etag, version[0])
     except SQLAlchemyError as e:
         app.logger.error(f"Database error: {e}")
         return jsonify({'error': 'Internal server error'}), 500
@@ -323,18 +950,7 @@ def update_build(build_id):
 
         db.session.commit()
 
-        return jsonify({
-            'id': build.id,
-            'hero_id': build.hero_id,
-            'name': build.name,
-            'description': build.description,
-            'items': build.items,
-            'skills': build.skills,
-            'talents': build.talents,
-            'playstyle': build.playstyle,
-            'votes': build.votes,
-            'updated_at': build.updated_at.isoformat() if build.updated_at else None
-        })
+        return jsonify(serialize_build(build))
     except SQLAlchemyError as e:
         db.session.rollback()
         app.logger.error(f"Database error: {e}")
@@ -364,17 +980,27 @@ def delete_build(build_id):
 def vote_build(build_id):
     # Проголосовать за сборку
     try:
-        build = HeroBuild.query.get_or_404(build_id)
-
-        data = request.get_json()
+        data = request.get_json(silent=True) or {}
         vote_value = data.get('vote', 1)  # По умолчанию +1 голос
-
-        build.votes += vote_value
-        db.session.commit()
+        if not isinstance(vote_value, int) or isinstance(vote_value, bool):
+            return jsonify({'error': 'vote must be an integer'}), 400
+
+        if app.config['VOTE_BATCHING']:
+            # Голос копится в памяти, в ответе - прогнозируемое значение с учетом буфера
+            votes = db.session.execute(db.select(HeroBuild.votes).where(HeroBuild.id == build_id)).scalar_one_or_none()
+            if votes is None:
+                abort(404)
+            votes += vote_aggregator.add(build_id, vote_value)
+        else:
+            # Атомарный инкремент в SQL вместо read-modify-write в Python
+            votes = increment_votes(build_id, vote_value)
+            if votes is None:
+                abort(404)
+            db.session.commit()
 
         return jsonify({
-            'id': build.id,
-            'votes': build.votes
+            'id': build_id,
+            'votes': votes
         })
     except SQLAlchemyError as e:
         db.session.rollback()
@@ -387,18 +1013,34 @@ def vote_build(build_id):
 def get_build_comments(build_id):
     # Получить комментарии к сборке
     try:
-        HeroBuild.query.get_or_404(build_id)
-
-        comments = BuildComment.query.filter_by(build_id=build_id).order_by(BuildComment.created_at.desc()).all()
+        if db.session.execute(db.select(HeroBuild.id).where(HeroBuild.id == build_id)).first() is None:
+            abort(404)
 
-        return jsonify([{
-            'id': comment.id,
-            'build_id': comment.build_id,
-            'author': comment.author,
-            'content': comment.content,
-            'rating': comment.rating,
-            'created_at': comment.created_at.isoformat()
-        } for comment in comments])
+        try:
+            limit, cursor = page_params()
+            if cursor:
+                if type(cursor[1]) is not int:
+                    raise ValueError('Invalid cursor')
+                cursor = datetime.fromisoformat(cursor[0]), cursor[1]
+        except (ValueError, TypeError):
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+        # Keyset-пагинация по (created_at, id), новые комментарии первыми
+        query = (
+            db.select(BuildComment.id, BuildComment.build_id, BuildComment.author, BuildComment.content,
+                      BuildComment.rating, BuildComment.created_at)
+            .where(BuildComment.build_id == build_id)
+            .order_by(BuildComment.created_at.desc(), BuildComment.id.desc())
+            .limit(limit + 1)
+        )
+        if cursor:
+            created_at, last_id = cursor
+            query = query.where(or_(BuildComment.created_at < created_at,
+                                    and_(BuildComment.created_at == created_at, BuildComment.id < last_id)))
+        comments = db.session.execute(query).all()
+
+        return paginated_response([serialize_comment(comment) for comment in comments], limit,
+                                  lambda comment: [comment['created_at'].isoformat(), comment['id']])
     except SQLAlchemyError as e:
         app.logger.error(f"Database error: {e}")
         return jsonify({'error': 'Internal server error'}), 500
@@ -424,14 +1066,7 @@ def create_build_comment(build_id):
         db.session.add(comment)
         db.session.commit()
 
-        return jsonify({
-            'id': comment.id,
-            'build_id': comment.build_id,
-            'author': comment.author,
-            'content': comment.content,
-            'rating': comment.rating,
-            'created_at': comment.created_at.isoformat()
-        }), 201
+        return jsonify(serialize_comment(comment)), 201
     except SQLAlchemyError as e:
         db.session.rollback()
         app.logger.error(f"Database error: {e}")
@@ -452,14 +1087,7 @@ def update_build_comment(comment_id):
 
         db.session.commit()
 
-        return jsonify({
-            'id': comment.id,
-            'build_id': comment.build_id,
-            'author': comment.author,
-            'content': comment.content,
-            'rating': comment.rating,
-            'created_at': comment.created_at.isoformat()
-        })
+        return jsonify(serialize_comment(comment))
     except SQLAlchemyError as e:
         db.session.rollback()
         app.logger.error(f"Database error: {e}")
@@ -482,47 +1110,266 @@ def delete_build_comment(comment_id):
         return jsonify({'error': 'Internal server error'}), 500
 
 
+# Роуты для драфта
+@app.route('/api/draft/recommend', methods=['POST'])
+def recommend_draft():
+    # Ранжировать всех доступных героев для текущего драфта
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    side = data.get('side', 'radiant')
+    if side not in ('radiant', 'dire'):
+        return jsonify({'error': "side must be 'radiant' or 'dire'"}), 400
+
+    try:
+        teams = {key: data.get(key, []) for key in ('radiant', 'dire', 'bans')}
+        if not all(isinstance(heroes, list) for heroes in teams.values()):
+            return jsonify({'error': 'radiant, dire and bans must be lists of hero ids'}), 400
+        if len(teams['radiant']) > 5 or len(teams['dire']) > 5:
+            return jsonify({'error': 'A team can pick at most 5 heroes'}), 400
+
+        taken = teams['radiant'] + teams['dire'] + teams['bans']
+        unknown = [hero_id for hero_id in taken
+                   if not isinstance(hero_id, int) or isinstance(hero_id, bool) or hero_registry.get(hero_id) is None]
+        if unknown:
+            return jsonify({'error': f"Unknown heroes: {unknown}"}), 400
+        if len(set(taken)) != len(taken):
+            return jsonify({'error': 'A hero can be picked or banned only once'}), 400
+
+        allies = teams[side]
+        enemies = teams['dire' if side == 'radiant' else 'radiant']
+        taken = set(taken)
+        candidates = [hero for hero in hero_registry.all() if hero.id not in taken]
+
+        score, synergy, counter = rank_candidates(
+            *pair_matrices(), [hero.id for hero in candidates], allies, enemies
+        )
+        order = np.argsort(-score, kind='stable')
+
+        return jsonify({
+            'side': side,
+            'recommendations': [{
+                'hero_id': candidates[i].id,
+                'localized_name': candidates[i].localized_name,
+                'score': round(float(score[i]), 2),
+                'synergy': round(float(synergy[i]), 2),
+                'counter': round(float(counter[i]), 2)
+            } for i in order]
+        })
+    except SQLAlchemyError as e:
+        app.logger.error(f"Database error: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+
 # Роуты для анализа матчей
 @app.route('/api/matches/<int:match_id>', methods=['GET'])
 def get_match_analysis(match_id):
-    # Получить анализ матча
-    try:
-        analysis = MatchAnalysis.query.filter_by(match_id=match_id).first()
+    # Получить анализ матча; ?sections=draft_analysis,... - только нужные секции.
+    # Недостающие секции считаются по первому запросу и дописываются в сохраненный анализ
+    sections = request.args.get('sections')
+    if sections is not None:
+        requested = {name.strip() for name in sections.split(',') if name.strip()}
+        unknown = requested - set(ANALYSIS_SECTIONS)
+        if unknown or not requested:
+            return jsonify({'error': f"Unknown sections: {', '.join(sorted(unknown))}" if unknown
+                            else 'sections must not be empty'}), 400
+        sections = [name for name in ANALYSIS_SECTIONS if name in requested]
 
-        if not analysis:
-            # Если анализа нет в базе, берем из OpenDota
-            match_data = fetch_opendota_data(f"matches/{match_id}")
-            if not match_data or match_data is None:
+    try:
+        # Сохраненный анализ с нужными секциями не менялся - 304 без загрузки самого анализа
+        variant = '+'.join(sections) if sections else ''
+        version = db.session.execute(
+            db.select(db.func.coalesce(MatchAnalysis.updated_at, MatchAnalysis.created_at))
+            .where(MatchAnalysis.match_id == match_id)
+        ).first()
+        if version is not None:
+            response = not_modified(version_etag('match', match_id, version[0], variant), version[0])
+            if response is not None:
+                return response
+
+        stored = {}
+
+        def lookup():
+            analysis = MatchAnalysis.query.filter_by(match_id=match_id).first()
+            stored['exists'] = analysis is not None
+            if analysis is not None and not missing_sections(analysis, sections):
+                return serialize_match_analysis(analysis, sections)
+            return None
+
+        def produce():
+            analysis = fill_analysis_sections(match_id, sections)
+            return serialize_match_analysis(analysis, sections) if analysis else MATCH_NOT_FOUND
+
+        result = lookup()
+        if result is None and not stored['exists'] and (
+                app.config['MATCH_ANALYSIS_ASYNC'] or request.args.get('async') == '1'):
+            # Анализ уходит в очередь, клиент забирает результат по ссылке на задание
+            job = enqueue_analysis_job(match_id)
+            return jsonify(serialize_job(job)), 202, {'Location': url_for('get_job', job_id=job.id)}
+        if result is None:
+            key = f"matches/{match_id}" + (f"?sections={','.join(sections)}" if sections else '')
+            result = single_flight(key, lookup, produce)
+            if result is MATCH_NOT_FOUND:
                 return jsonify({'error': 'Match not found'}), 404
 
-            # Это базовый анализ
-            analysis = MatchAnalysis(
-                match_id=match_id,
-                radiant_win=match_data.get('radiant_win'),
-                duration=match_data.get('duration'),
-                analysis={
-                    'draft_analysis': analyze_draft(match_data),
-                    'key_moments': identify_key_moments(match_data),
-                    'performance_metrics': calculate_performance_metrics(match_data)
-                }
-            )
+        version = result['updated_at'] or result['created_at']
+        return with_validators(jsonify(result), version_etag('match', match_id, version, variant), version)
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        app.logger.error(f"Database error: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
 
-            db.session.add(analysis)
+
+@app.route('/api/matches/<int:match_id>/moments', methods=['GET'])
+def get_match_moments(match_id):
+    # Ключевые моменты матча за отрезок времени: ?from=&to= (секунды), ?type=, ?team=
+    bounds = {}
+    for name in ('from', 'to', 'team'):
+        value = request.args.get(name)
+        try:
+            bounds[name] = int(value) if value is not None else None
+        except ValueError:
+            return jsonify({'error': f"{name} must be an integer"}), 400
+    start, end, team = bounds['from'], bounds['to'], bounds['team']
+    moment_type = request.args.get('type')
+    try:
+        analysis = db.session.execute(
+            db.select(MatchAnalysis).where(MatchAnalysis.match_id == match_id)
+        ).scalar_one_or_none()
+        if analysis is None or missing_sections(analysis, ['key_moments']):
+            analysis = fill_analysis_sections(match_id, ['key_moments'])
+            if analysis is None:
+                return jsonify({'error': 'Match not found'}), 404
+
+        stored = analysis.analysis
+        key_moments = stored.get('key_moments') if isinstance(stored, dict) else None
+        if analysis.moments_index is None and key_moments:
+            # Анализ записан до появления индекса - строим и сохраняем один раз
+            analysis.moments_index = build_moments_index(key_moments)
             db.session.commit()
 
-        return jsonify({
-            'match_id': analysis.match_id,
-            'radiant_win': analysis.radiant_win,
-            'duration': analysis.duration,
-            'analysis': analysis.analysis,
-            'created_at': analysis.created_at.isoformat()
-        })
+        moments = query_moments(key_moments, analysis.moments_index, start, end, moment_type, team) \
+            if key_moments else []
+        return jsonify({'match_id': match_id, 'count': len(moments), 'moments': moments})
     except SQLAlchemyError as e:
         db.session.rollback()
         app.logger.error(f"Database error: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
 
+@app.route('/api/matches/batch', methods=['POST'])
+def get_match_analyses_batch():
+    # Анализы пачки матчей: сохраненные - одним IN-запросом, недостающие - параллельно из OpenDota.
+    # Результаты отдаются построчно (NDJSON) по мере готовности
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    match_ids = data.get('match_ids')
+    if not isinstance(match_ids, list) or not all(isinstance(match_id, int) and not isinstance(match_id, bool)
+                                                  for match_id in match_ids):
+        return jsonify({'error': 'match_ids must be a list of integers'}), 400
+    if len(match_ids) > app.config['MATCH_BATCH_MAX']:
+        return jsonify({'error': f"At most {app.config['MATCH_BATCH_MAX']} matches per batch"}), 400
+    match_ids = list(dict.fromkeys(match_ids))
+
+    def line(payload):
+        return app.json.dumps(payload) + '\n'
+
+    def generate():
+        try:
+            stored = db.session.execute(
+                db.select(MatchAnalysis).where(MatchAnalysis.match_id.in_(match_ids))
+            ).scalars().all()
+            # Анализы, сохраненные запросом с ?sections=, сначала досчитываем до полных
+            partial = [analysis.match_id for analysis in stored if missing_sections(analysis, None)]
+            for analysis in stored:
+                if analysis.match_id not in partial:
+                    yield line(serialize_match_analysis(analysis))
+            for match_id in partial:
+                yield line(serialize_match_analysis(fill_analysis_sections(match_id, None)))
+
+            found = {analysis.match_id for analysis in stored}
+            missing = [match_id for match_id in match_ids if match_id not in found]
+            created = []
+            skipped = []
+            not_found = 0
+            teams = {}
+
+            if missing:
+                workers = min(app.config['MATCH_BATCH_WORKERS'], len(missing))
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='match-batch') as pool:
+                    futures = {pool.submit(load_match_data, match_id): match_id
+                               for match_id in missing}
+                    for future in as_completed(futures):
+                        match_id, match_data = futures[future], future.result()
+                        if not match_data:
+                            not_found += 1
+                            yield line({'match_id': match_id, 'error': 'Match not found'})
+                            continue
+                        created.append(build_match_analysis(match_id, match_data))
+                        teams[match_id] = (*draft_teams(match_data), match_data.get('radiant_win'))
+
+            # Все новые анализы - одной транзакцией; параллельно записанные кем-то еще пропускаем.
+            # Новые строки отдаются только после успешного коммита
+            if created:
+                existing = set(db.session.execute(
+                    db.select(MatchAnalysis.match_id)
+                    .where(MatchAnalysis.match_id.in_([analysis.match_id for analysis in created]))
+                ).scalars())
+                skipped = [analysis.match_id for analysis in created if analysis.match_id in existing]
+                created = [analysis for analysis in created if analysis.match_id not in existing]
+                db.session.add_all(created)
+                update_hero_performance(added=[snapshot(analysis) for analysis in created])
+                pairs = record_match_pairs([teams[analysis.match_id] for analysis in created])
+                db.session.commit()
+                apply_local_pairs(pairs)
+
+                for analysis in created:
+                    yield line(serialize_match_analysis(analysis))
+                if skipped:
+                    # Отдаем то, что сохранил параллельный запрос
+                    for analysis in db.session.execute(
+                        db.select(MatchAnalysis).where(MatchAnalysis.match_id.in_(skipped))
+                    ).scalars():
+                        yield line(serialize_match_analysis(analysis))
+
+            yield line({'stored': len(found), 'created': len(created),
+                        'stored_concurrently': len(skipped), 'not_found': not_found})
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            app.logger.error(f"Database error: {e}")
+            yield line({'error': 'Internal server error'})
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    # Статус задания анализа; ?wait=N - ждать завершения до N секунд (long-poll)
+    try:
+        wait = max(0.0, min(request.args.get('wait', 0, type=float), app.config['JOB_MAX_WAIT']))
+        deadline = time.monotonic() + wait
+        while True:
+            job = db.session.get(AnalysisJob, job_id)
+            if job is None:
+                return jsonify({'error': 'Job not found'}), 404
+            if job.status in ('done', 'failed') or time.monotonic() >= deadline:
+                break
+            db.session.expire_all()
+            time.sleep(0.1)
+
+        payload = serialize_job(job)
+        if job.status == 'done':
+            analysis = MatchAnalysis.query.filter_by(match_id=job.match_id).first()
+            payload['result'] = serialize_match_analysis(analysis) if analysis else None
+        return jsonify(payload)
+    except SQLAlchemyError as e:
+        app.logger.error(f"Database error: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+
 @app.route('/api/matches/<int:match_id>', methods=['PATCH'])
 def update_match_analysis(match_id):
     # Обновить анализ матча
@@ -531,17 +1378,13 @@ def update_match_analysis(match_id):
 
         data = request.get_json()
         if 'analysis' in data:
+            before = snapshot(analysis)
             analysis.analysis = data['analysis']
+            update_hero_performance(added=[snapshot(analysis)], removed=[before])
 
         db.session.commit()
 
-        return jsonify({
-            'match_id': analysis.match_id,
-            'radiant_win': analysis.radiant_win,
-            'duration': analysis.duration,
-            'analysis': analysis.analysis,
-            'created_at': analysis.created_at.isoformat()
-        })
+        return jsonify(serialize_match_analysis(analysis))
     except SQLAlchemyError as e:
         db.session.rollback()
         app.logger.error(f"Database error: {e}")
@@ -554,8 +1397,11 @@ def delete_match_analysis(match_id):
     try:
         analysis = MatchAnalysis.query.filter_by(match_id=match_id).first_or_404()
 
+        update_hero_performance(removed=[snapshot(analysis)])
+        pairs = remove_match_pairs(analysis)
         db.session.delete(analysis)
         db.session.commit()
+        apply_local_pairs(pairs)
 
         return jsonify({'message': 'Match analysis deleted successfully'}), 200
     except SQLAlchemyError as e:
@@ -565,16 +1411,86 @@ def delete_match_analysis(match_id):
 
 
 # Вспомогательные функции для анализа матчей
+def analyze_match(match_data, sections=None):
+    # Это базовый анализ; sections - посчитать только эти секции
+    return {
+        name: analyzer(match_data)
+        for name, analyzer in ANALYSIS_SECTIONS.items()
+        if sections is None or name in sections
+    }
+
+
+def fill_analysis_sections(match_id, sections):
+    # Досчитать недостающие секции анализа по архиву или OpenDota и сохранить.
+    # None - анализа нет и матч не найден; без сырых данных возвращается то, что уже посчитано
+    analysis = MatchAnalysis.query.filter_by(match_id=match_id).first()
+    missing = missing_sections(analysis, sections) if analysis else sections
+    match_data = load_match_data(match_id)
+    if not match_data:
+        return analysis
+
+    computed = analyze_match(match_data, missing)
+    if analysis is None:
+        analysis = build_match_analysis(match_id, match_data, analysis=computed)
+        db.session.add(analysis)
+        update_hero_performance(added=[snapshot(analysis)])
+        pairs = record_match_pairs([(*draft_teams(match_data), match_data.get('radiant_win'))])
+    else:
+        merge_analysis_sections(analysis, computed)
+        pairs = []
+    db.session.commit()
+    apply_local_pairs(pairs)
+    return analysis
+
+
+def merge_analysis_sections(analysis, computed):
+    # Дописать посчитанные секции в сохраненный анализ и поправить сводки героев
+    before = snapshot(analysis)
+    previous = before[0]
+    analysis.analysis = {**(previous if isinstance(previous, dict) else {}), **computed}
+    update_hero_performance(added=[snapshot(analysis)], removed=[before])
+
+
+def missing_sections(analysis, sections):
+    # Какие из запрошенных секций еще не посчитаны; без sections - все секции анализа
+    if sections is None:
+        sections = list(ANALYSIS_SECTIONS)
+    stored = analysis.analysis
+    if not isinstance(stored, dict):
+        return list(sections)
+    return [name for name in sections if name not in stored]
+
+
+def build_match_analysis(match_id, match_data, analysis=None):
+    return MatchAnalysis(
+        match_id=match_id,
+        radiant_win=match_data.get('radiant_win'),
+        duration=match_data.get('duration'),
+        analysis=analysis if analysis is not None else analyze_match(match_data),
+        created_at=datetime.utcnow()
+    )
+
+
+def draft_teams(match_data):
+    # Герои Radiant и Dire по слотам игроков
+    players = match_data.get('players', [])
+    return [p['hero_id'] for p in players[:5]], [p['hero_id'] for p in players[5:10]]
+
+
 def analyze_draft(match_data):
     # Анализ драфта матча
     # Упрощенный анализ драфта
-    radiant_heroes = [p['hero_id'] for p in match_data.get('players', [])[:5]]
-    dire_heroes = [p['hero_id'] for p in match_data.get('players', [])[5:10]]
+    return draft_analysis(*draft_teams(match_data))
+
 
+def draft_analysis(radiant_heroes, dire_heroes):
+    # Оценки по матрицам пар; при PAIR_STATS_SOURCE=local матрицы читаются из БД,
+    # поэтому в процессах пула заданий не вызывается (см. run_analysis_worker)
     return {
         'radiant_heroes': radiant_heroes,
         'dire_heroes': dire_heroes,
         'synergy_score': calculate_synergy_score(radiant_heroes),
+        'dire_synergy_score': calculate_synergy_score(dire_heroes),
         'counter_score': calculate_counter_score(radiant_heroes, dire_heroes)
     }
 
@@ -614,6 +1530,149 @@ def identify_key_moments(match_data):
     return key_moments
 
 
+# Задания асинхронного анализа
+def serialize_job(job):
+    return {
+        'job_id': job.id,
+        'match_id': job.match_id,
+        'status': job.status,
+        'error': job.error,
+        'status_url': url_for('get_job', job_id=job.id)
+    }
+
+
+def enqueue_analysis_job(match_id):
+    # Поставить матч в очередь; активное задание по тому же матчу переиспользуем
+    job = AnalysisJob.query.filter(
+        AnalysisJob.match_id == match_id, AnalysisJob.status.in_(('queued', 'running'))
+    ).first()
+    if job is not None:
+        return job
+
+    job = AnalysisJob(id=uuid.uuid4().hex, match_id=match_id, status='queued')
+    db.session.add(job)
+    db.session.commit()
+    dispatch_job(job.id, match_id)
+    db.session.refresh(job)
+    return job
+
+
+def claim_job(job_id):
+    # queued -> running атомарно, чтобы одно задание не взяли два процесса
+    claimed = db.session.execute(
+        db.update(AnalysisJob)
+        .where(AnalysisJob.id == job_id, AnalysisJob.status == 'queued')
+        .values(status='running')
+    ).rowcount == 1
+    db.session.commit()
+    return claimed
+
+
+def dispatch_job(job_id, match_id):
+    if not claim_job(job_id):
+        return False
+
+    if app.config['JOB_WORKERS'] <= 0:
+        try:
+            result, error = run_analysis_worker(match_id), None
+        except Exception as e:
+            result, error = None, str(e)
+        finish_job(job_id, match_id, result, error)
+    else:
+        future = get_job_pool().submit(run_analysis_worker, match_id)
+        future.add_done_callback(partial(_on_job_done, job_id, match_id))
+    return True
+
+
+def pool_context():
+    # Процессы пулов запускаются без fork веб-процесса и ничего от него не наследуют
+    # (соединения, блокировки, матрицы): forkserver, а где его нет (Windows) - spawn
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def get_job_pool():
+    global _job_pool
+    with _job_pool_lock:
+        if _job_pool is None:
+            _job_pool = ProcessPoolExecutor(max_workers=app.config['JOB_WORKERS'], mp_context=pool_context(),
+                                            initializer=_init_job_worker)
+        return _job_pool
+
+
+def shutdown_job_pool():
+    global _job_pool
+    with _job_pool_lock:
+        pool, _job_pool = _job_pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+def _init_job_worker():
+    # Процесс пула: свой пул соединений к OpenDota и свои экземпляры архива и общего кэша
+    global _match_archive, _shared_cache
+    opendota.reset_session()
+    _match_archive = None
+    _shared_cache = None
+
+
+def run_analysis_worker(match_id):
+    # Выполняется в процессе пула: выборка (архив или OpenDota) и анализ без обращения к БД.
+    # Оценки драфта зависят от матриц пар и досчитываются в родителе (finish_job)
+    match_data = load_match_data(match_id)
+    if not match_data:
+        return None
+    return {
+        'radiant_win': match_data.get('radiant_win'),
+        'duration': match_data.get('duration'),
+        'teams': draft_teams(match_data),
+        'analysis': analyze_match(match_data, POOL_SECTIONS)
+    }
+
+
+def _on_job_done(job_id, match_id, future):
+    try:
+        result, error = future.result(), None
+    except Exception as e:
+        result, error = None, str(e)
+    try:
+        with app.app_context():
+            finish_job(job_id, match_id, result, error)
+    except Exception as e:
+        app.logger.error(f"Error finishing job {job_id}: {e}")
+
+
+def finish_job(job_id, match_id, result, error=None):
+    # Результат задания пишется в match_analyses в процессе веб-приложения
+    if error is None and result is None:
+        error = 'Match not found'
+    try:
+        existing = MatchAnalysis.query.filter_by(match_id=match_id).first() if error is None else None
+        pairs = []
+        if error is None:
+            result['analysis'] = {'draft_analysis': draft_analysis(*result['teams']), **result['analysis']}
+        if error is None and existing is None:
+            analysis = build_match_analysis(match_id, result, analysis=result['analysis'])
+            db.session.add(analysis)
+            update_hero_performance(added=[snapshot(analysis)])
+            draft = result['analysis']['draft_analysis']
+            pairs = record_match_pairs([(draft['radiant_heroes'], draft['dire_heroes'], result.get('radiant_win'))])
+        elif existing is not None:
+            # Пока задание выполнялось, запрос с ?sections= сохранил часть секций - дописываем остальные
+            missing = missing_sections(existing, None)
+            if missing:
+                merge_analysis_sections(existing, {name: result['analysis'][name] for name in missing})
+        db.session.execute(
+            db.update(AnalysisJob).where(AnalysisJob.id == job_id)
+            .values(status='failed' if error else 'done', error=error)
+        )
+        db.session.commit()
+        apply_local_pairs(pairs)
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+
+
 def calculate_performance_metrics(match_data):
     # Расчет метрик производительности игроков
     metrics = []
@@ -635,14 +1694,63 @@ def calculate_performance_metrics(match_data):
     return metrics
 
 
+# Секции анализа матча в порядке ответа
+ANALYSIS_SECTIONS = {
+    'draft_analysis': analyze_draft,
+    'key_moments': identify_key_moments,
+    'performance_metrics': calculate_performance_metrics
+}
+
+# Секции, которые считают процессы пулов: оценки драфта зависят от матриц пар
+# и досчитываются в родителе (draft_analysis по составам команд)
+POOL_SECTIONS = [name for name in ANALYSIS_SECTIONS if name != 'draft_analysis']
+
+
 def calculate_synergy_score(heroes):
-    # Расчет синергии
-    return len(heroes) * 10  # Костыль, придумать алгоритм для расчета синергии не успел.
+    # Синергия: общий винрейт пар союзников по матрице синергий (50 - нейтрально)
+    return pair_matrices()[0].pair_win_rate(heroes, heroes, symmetric=True)
 
 
 def calculate_counter_score(team_a, team_b):
-    # Расчет контрпиков
-    return len(team_a) * 5  # Снова костыль)
+    # Контрпики: общий винрейт героев team_a против героев team_b по матрице матчапов
+    return pair_matrices()[1].pair_win_rate(team_a, team_b)
+
+
+def parse_team(team):
+    # Герои команды из publicMatches: список ID или строка "1,2,3,4,5"
+    if isinstance(team, str):
+        team = team.split(',')
+    try:
+        heroes = [int(hero_id) for hero_id in team or ()]
+    except (TypeError, ValueError):
+        return None
+    return heroes if len(heroes) == 5 else None
+
+
+def write_synergy_rows(matrix, min_games):
+    # Пары союзников с достаточным числом игр - в hero_synergies (в обе стороны), одной вставкой
+    rates = matrix.win_rates()
+    rows = []
+    for hero_id, ally_id in zip(*np.nonzero(matrix.games >= min_games)):
+        hero_id, ally_id = int(hero_id), int(ally_id)
+        if hero_registry.get(hero_id) and hero_registry.get(ally_id):
+            win_rate = round(float(rates[hero_id, ally_id]), 2)
+            rows.append({
+                'hero_id': hero_id,
+                'synergy_hero_id': ally_id,
+                'win_rate': win_rate,
+                'reason': f"Win rate of {win_rate}% together in {int(matrix.games[hero_id, ally_id])} matches"
+            })
+
+    try:
+        db.session.execute(db.delete(HeroSynergy))
+        if rows:
+            db.session.execute(db.insert(HeroSynergy), rows)
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    return len(rows)
 
 
 # Инициализация базы данных
@@ -668,6 +1776,275 @@ def init_db():
             print("Database initialized with Dota 2 heroes")
         else:
             print("Failed to fetch heroes data from OpenDota")
+        hero_registry.invalidate()
+        # База пересоздана: сбрасываем в общем кэше все ключи сразу
+        shared = get_shared_cache()
+        if shared is not None:
+            shared.bump()
+
+
+@app.cli.command("migrate-db")
+def migrate_db():
+    # Обновление схемы существующей БД без потери данных (в отличие от init-db)
+    with app.app_context():
+        changes = migrate_schema()
+        for change in changes:
+            print(change)
+        print("Database schema is up to date" if not changes else f"Applied {len(changes)} changes")
+
+
+@app.cli.command("migrate-analysis")
+@click.option('--to', 'storage', type=click.Choice(['json', 'compact']), default=None,
+              help='Target format (default: ANALYSIS_STORAGE).')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per transaction.')
+def migrate_analysis(storage, batch_size):
+    # Перекодировать сохраненные анализы в другой формат хранения пачками по id
+    storage = storage or app.config['ANALYSIS_STORAGE']
+    analyses = MatchAnalysis.__table__
+    with app.app_context():
+        # Уже записанные в нужном формате строки не трогаем
+        pending = analyses.c.analysis_blob.is_(None) if storage == 'compact' else analyses.c.analysis_blob.isnot(None)
+        stored_bytes = db.select(db.func.sum(db.func.length(db.cast(analyses.c.analysis, db.Text))),
+                                 db.func.sum(db.func.length(analyses.c.analysis_blob)))
+        before = db.session.execute(stored_bytes).one()
+
+        last_id = migrated = 0
+        while True:
+            rows = db.session.execute(
+                db.select(MatchAnalysis).where(pending, MatchAnalysis.id > last_id)
+                .order_by(MatchAnalysis.id).limit(batch_size)
+            ).scalars().all()
+            if not rows:
+                break
+            params = []
+            for row in rows:
+                values = MatchAnalysis.encode_columns(row.analysis, storage)
+                params.append({'b_id': row.id, 'analysis': values['analysis'],
+                               'analysis_blob': values['analysis_blob']})
+            try:
+                db.session.execute(
+                    analyses.update().where(analyses.c.id == bindparam('b_id'))
+                    .values(analysis=bindparam('analysis'), analysis_blob=bindparam('analysis_blob')),
+                    params
+                )
+                db.session.commit()
+            except SQLAlchemyError:
+                db.session.rollback()
+                raise
+            last_id = rows[-1].id
+            db.session.expunge_all()
+            migrated += len(rows)
+            print(f"{migrated} analyses converted to {storage}")
+
+        after = db.session.execute(stored_bytes).one()
+        print(f"Migrated {migrated} analyses to {storage}: "
+              f"{sum(filter(None, before))} -> {sum(filter(None, after))} bytes")
+
+
+@app.cli.command("process-jobs")
+def process_jobs():
+    # Доработать задания из очереди в БД, например после перезапуска веб-процессов
+    with app.app_context():
+        stale_before = datetime.utcnow() - timedelta(seconds=app.config['JOB_STALE_AFTER'])
+        requeued = db.session.execute(
+            db.update(AnalysisJob)
+            .where(AnalysisJob.status == 'running', AnalysisJob.updated_at < stale_before)
+            .values(status='queued')
+        ).rowcount
+        db.session.commit()
+
+        jobs = db.session.execute(
+            db.select(AnalysisJob.id, AnalysisJob.match_id).where(AnalysisJob.status == 'queued')
+        ).all()
+        dispatched = sum(dispatch_job(job.id, job.match_id) for job in jobs)
+        shutdown_job_pool()
+        print(f"Processed {dispatched} jobs ({requeued} stale jobs requeued)")
+
+
+def warm_hero_counters(hero_id):
+    # Выполняется в потоке пула warm-counters: у потока свой контекст приложения и своя сессия БД
+    with app.app_context():
+        return calculate_counters(hero_id, True)
+
+
+@app.cli.command("warm-counters")
+@click.option('--workers', default=8, show_default=True, help='Concurrent OpenDota requests.')
+@click.option('--batch-size', default=25, show_default=True, help='Heroes per bulk insert.')
+def warm_counters(workers, batch_size):
+    # Прогрев таблицы контрпиков для всех героев сразу после деплоя
+    with app.app_context():
+        heroes = hero_registry.all()
+        if not heroes:
+            print("No heroes in database, run init-db first")
+            return
+
+        started = time.perf_counter()
+        done = failed = written = 0
+        batch = []
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='warm-counters') as pool:
+            futures = {pool.submit(warm_hero_counters, hero.id): hero.id for hero in heroes}
+            for future in as_completed(futures):
+                counters_data = future.result()
+                done += 1
+                if counters_data:
+                    batch.append((futures[future], counters_data))
+                else:
+                    failed += 1
+
+                if len(batch) >= batch_size or done == len(heroes):
+                    if batch:
+                        written += write_counter_batch(batch)
+                        batch = []
+                    elapsed = time.perf_counter() - started
+                    print(f"[{done}/{len(heroes)}] {written} counters written, "
+                          f"{done / elapsed:.1f} heroes/s")
+
+        matchup_matrix.save(app.config['MATCHUP_MATRIX_PATH'])
+        print(f"Warmed counters for {done - failed} heroes in {time.perf_counter() - started:.1f}s"
+              f" ({failed} failed)")
+
+
+@app.cli.command("build-synergies")
+@click.option('--pages', default=50, show_default=True, help='Pages of publicMatches (100 matches each).')
+@click.option('--min-games', default=20, show_default=True, help='Minimum games for a stored pair.')
+def build_synergies(pages, min_games):
+    # Таблица синергий по выборке публичных матчей OpenDota
+    global synergy_matrix
+
+    with app.app_context():
+        matrix = MatchupMatrix()
+        matches = 0
+        less_than = None
+
+        for page in range(pages):
+            endpoint = 'publicMatches' + (f'?less_than_match_id={less_than}' if less_than else '')
+            data = fetch_opendota_data(endpoint)
+            if not data:
+                break
+
+            for match in data:
+                radiant, dire = parse_team(match.get('radiant_team')), parse_team(match.get('dire_team'))
+                if radiant is None or dire is None or match.get('radiant_win') is None:
+                    continue
+                matrix.add_allies(radiant, match['radiant_win'])
+                matrix.add_allies(dire, not match['radiant_win'])
+                matches += 1
+
+            less_than = min(match['match_id'] for match in data)
+            print(f"[{page + 1}/{pages}] {matches} matches processed")
+
+        written = write_synergy_rows(matrix, min_games)
+        matrix.save(app.config['SYNERGY_MATRIX_PATH'])
+        synergy_matrix = matrix
+        print(f"Built synergies from {matches} matches, {written} pairs stored")
+
+
+def reanalyze_record(record):
+    # Выполняется в процессе пула: распаковка записи архива и анализ без обращения к БД;
+    # None - битая запись. Оценки драфта досчитываются в родителе (reanalyzed_row)
+    match_id, data = record
+    try:
+        match_data = decode_record(data)
+    except (zlib.error, ValueError):
+        return None
+    return {
+        'match_id': match_id,
+        'radiant_win': match_data.get('radiant_win'),
+        'duration': match_data.get('duration'),
+        'teams': draft_teams(match_data),
+        'analysis': analyze_match(match_data, POOL_SECTIONS)
+    }
+
+
+def reanalyzed_row(result):
+    # Строка для write_reanalyzed: оценки драфта по матрицам пар этого процесса
+    row = {
+        'b_match_id': result['match_id'],
+        'radiant_win': result['radiant_win'],
+        'duration': result['duration']
+    }
+    row.update(MatchAnalysis.encode_columns({'draft_analysis': draft_analysis(*result['teams']),
+                                             **result['analysis']}))
+    return row
+
+
+def write_reanalyzed(rows):
+    # Один executemany UPDATE по match_id на всю пачку
+    analyses = MatchAnalysis.__table__
+    try:
+        updated = db.session.execute(
+            analyses.update()
+            .where(analyses.c.match_id == bindparam('b_match_id'))
+            .values(radiant_win=bindparam('radiant_win'), duration=bindparam('duration'),
+                    analysis=bindparam('analysis'), analysis_blob=bindparam('analysis_blob'),
+                    moments_index=bindparam('moments_index')),
+            rows
+        ).rowcount
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    return updated
+
+
+@app.cli.command("reanalyze")
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True,
+              help='Analyzer processes (0 - in this process).')
+@click.option('--batch-size', default=500, show_default=True, help='Matches per bulk update.')
+def reanalyze(workers, batch_size):
+    # Повторный анализ сохраненных матчей по архиву, без обращения к OpenDota
+    with app.app_context():
+        archive = get_match_archive()
+        if archive is None:
+            print("Match archive is disabled (MATCH_ARCHIVE_DIR is empty)")
+            return
+
+        started = time.perf_counter()
+        records = archive.iter_compressed()
+        pool = None
+        if workers > 0:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=pool_context())
+        processed = updated = failed = 0
+        try:
+            while True:
+                chunk = list(islice(records, batch_size))
+                if not chunk:
+                    break
+                if pool is not None:
+                    results = pool.map(reanalyze_record, chunk, chunksize=max(1, len(chunk) // (workers * 4)))
+                else:
+                    results = map(reanalyze_record, chunk)
+                rows = [reanalyzed_row(result) for result in results if result is not None]
+                failed += len(chunk) - len(rows)
+                if rows:
+                    updated += write_reanalyzed(rows)
+                processed += len(chunk)
+                elapsed = time.perf_counter() - started
+                print(f"{processed} matches reanalyzed, {updated} analyses updated, "
+                      f"{processed / elapsed:.1f} matches/s")
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        # Метрики игроков могли измениться - сводку по героям пересчитываем целиком
+        rebuild_hero_performance()
+        db.session.commit()
+        print(f"Reanalyzed {processed - failed} archived matches in {time.perf_counter() - started:.1f}s"
+              f" ({updated} analyses updated, {failed} unreadable)")
+
+
+@app.cli.command("rebuild-hero-stats")
+def rebuild_hero_stats():
+    # Пересчитать сводку метрик героев по всем сохраненным анализам (например, после migrate-db)
+    with app.app_context():
+        try:
+            matches = rebuild_hero_performance()
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+        print(f"Hero stats rebuilt from {matches} analyses")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,216 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from contextlib import contextmanager
+
+from locks import file_lock
+
+# Индекс - хэш-таблица с открытой адресацией из записей фиксированного размера:
+# match_id, номер сегмента, смещение и длина сжатой записи. Поиск идет прямо по mmap файла
+INDEX_RECORD = struct.Struct('<QIQI')
+SLOT_ID = struct.Struct('<Q')
+LOCATION = struct.Struct('<IQI')
+# Заголовок таблицы: занятые слоты (вместе с удаленными) и живые записи
+HEADER = struct.Struct('<QQ8x')
+# match_id пустого слота и записи, замененной более новой версией матча
+EMPTY, TOMBSTONE = 0, 2 ** 64 - 1
+INITIAL_SLOTS = 1024
+MAX_LOAD = 0.5
+
+
+def _slots(index):
+    return (len(index) - HEADER.size) // INDEX_RECORD.size
+
+
+def _lookup(index, match_id, find_empty=False):
+    # (позиция живой записи, (сегмент, смещение, длина), позиция первого пустого слота цепочки -
+    # только при find_empty). Хэш Фибоначчи и линейное пробирование; пустой слот обрывает цепочку
+    slots = _slots(index)
+    slot = ((match_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> (65 - slots.bit_length())
+    found = location = None
+    for _ in range(slots):
+        position = HEADER.size + slot * INDEX_RECORD.size
+        current = SLOT_ID.unpack_from(index, position)[0]
+        if current == EMPTY:
+            return found, location, position
+        if current == match_id:
+            found, location = position, LOCATION.unpack_from(index, position + SLOT_ID.size)
+            if not find_empty:
+                break
+        slot = (slot + 1) & (slots - 1)
+    return found, location, None
+
+
+def _live_records(index):
+    return [record for record in INDEX_RECORD.iter_unpack(index[HEADER.size:]) if record[0] not in (EMPTY, TOMBSTONE)]
+
+
+class MatchArchive:
+    # Append-only архив сырых ответов OpenDota: записи сжимаются zlib и дописываются
+    # в файлы-сегменты, индекс match_id -> (сегмент, смещение, длина) - хэш-таблица в mmap.
+    # При заполнении таблица перестраивается в файл следующего поколения
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._index = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        with self._write_lock():
+            if self._latest_generation() == 0:
+                self._write_table(self._legacy_records(), 1)
+        self._refresh_index()
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"segment-{segment:05d}.z")
+
+    def index_path(self, generation):
+        return os.path.join(self.directory, f"index-{generation:05d}.tbl")
+
+    def _latest_generation(self):
+        names = [name for name in os.listdir(self.directory) if name.startswith('index-') and name.endswith('.tbl')]
+        return max((int(name[6:11]) for name in names), default=0)
+
+    def _legacy_records(self):
+        # Индекс прежнего формата (журнал записей на дозапись) переносится в таблицу один раз
+        try:
+            with open(os.path.join(self.directory, 'index.bin'), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        data = data[:len(data) - len(data) % INDEX_RECORD.size]  # недописанную запись пропускаем
+        return list({record[0]: record for record in INDEX_RECORD.iter_unpack(data)}.values())
+
+    def _write_table(self, records, generation):
+        # Новая таблица с запасом до следующего роста; старые поколения удаляются
+        slots = INITIAL_SLOTS
+        while len(records) + 1 > slots * MAX_LOAD / 2:
+            slots *= 2
+        table = bytearray(HEADER.size + slots * INDEX_RECORD.size)
+        HEADER.pack_into(table, 0, len(records), len(records))
+        for record in records:
+            INDEX_RECORD.pack_into(table, _lookup(table, record[0], True)[2], *record)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(table)
+        os.replace(tmp_path, self.index_path(generation))
+        for old in range(1, generation):
+            try:
+                os.remove(self.index_path(old))
+            except OSError:  # уже удалено или (Windows) еще отображено в другом процессе
+                pass
+
+    def _refresh_index(self):
+        # Переходим на последнее поколение таблицы, если ее перестроил другой процесс
+        while True:
+            generation = self._latest_generation()
+            if generation <= self._generation:
+                return
+            try:
+                with open(self.index_path(generation), 'r+b') as f:
+                    # Старое отображение не закрываем: его могут читать другие потоки
+                    self._index = mmap.mmap(f.fileno(), 0)
+            except FileNotFoundError:  # поколение уже заменено следующим
+                continue
+            self._generation = generation
+
+    @contextmanager
+    def _write_lock(self):
+        with self._lock, file_lock(os.path.join(self.directory, 'lock')):
+            yield
+
+    def _current_segment(self):
+        segments = [name for name in os.listdir(self.directory) if name.startswith('segment-')]
+        segment = max((int(name[8:13]) for name in segments), default=1)
+        path = self.segment_path(segment)
+        if os.path.exists(path) and os.path.getsize(path) >= self.segment_size:
+            segment += 1
+        return segment
+
+    def append(self, match_id, payload):
+        data = zlib.compress(json.dumps(payload, separators=(',', ':')).encode(), 6)
+        with self._write_lock():
+            self._refresh_index()
+            segment = self._current_segment()
+            with open(self.segment_path(segment), 'ab') as f:
+                offset = f.tell()
+                f.write(data)
+            self._insert(match_id, (segment, offset, len(data)))
+
+    def _insert(self, match_id, location):
+        # Под блокировкой записи. Новая версия пишется в пустой слот (сначала положение, потом
+        # match_id), прежняя помечается TOMBSTONE только после этого: читатели без блокировки
+        # находят либо старую, либо новую версию целиком
+        index = self._index
+        used, live = HEADER.unpack_from(index, 0)
+        if used + 1 > _slots(index) * MAX_LOAD:
+            records = {record[0]: record for record in _live_records(index)}
+            records[match_id] = (match_id, *location)
+            self._write_table(list(records.values()), self._generation + 1)
+            self._refresh_index()
+            return
+        previous, _, empty = _lookup(index, match_id, True)
+        LOCATION.pack_into(index, empty + SLOT_ID.size, *location)
+        SLOT_ID.pack_into(index, empty, match_id)
+        if previous is not None:
+            SLOT_ID.pack_into(index, previous, TOMBSTONE)
+        HEADER.pack_into(index, 0, used + 1, live + (previous is None))
+
+    def _location(self, match_id):
+        location = _lookup(self._index, match_id)[1]
+        if location is None:
+            with self._lock:
+                self._refresh_index()
+            location = _lookup(self._index, match_id)[1]
+        return location
+
+    def get(self, match_id):
+        location = self._location(match_id)
+        if location is None:
+            return None
+        segment, offset, length = location
+        with open(self.segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            return json.loads(zlib.decompress(f.read(length)))
+
+    def __contains__(self, match_id):
+        return self._location(match_id) is not None
+
+    def __len__(self):
+        with self._lock:
+            self._refresh_index()
+        return HEADER.unpack_from(self._index, 0)[1]
+
+    def iter_compressed(self):
+        # Последняя версия каждого матча в порядке записи: (match_id, сжатые байты).
+        # Сегменты читаются через mmap, распаковку оставляем потребителю
+        with self._lock:
+            self._refresh_index()
+            locations = sorted(((match_id, (segment, offset, length))
+                                for match_id, segment, offset, length in _live_records(self._index)),
+                               key=lambda item: item[1])
+
+        current, segment_file, segment_map = None, None, None
+        try:
+            for match_id, (segment, offset, length) in locations:
+                if segment != current:
+                    if segment_map is not None:
+                        segment_map.close()
+                        segment_file.close()
+                    segment_file = open(self.segment_path(segment), 'rb')
+                    segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+                    current = segment
+                yield match_id, segment_map[offset:offset + length]
+        finally:
+            if segment_map is not None:
+                segment_map.close()
+                segment_file.close()
+
+
+def decode_record(data):
+    return json.loads(zlib.decompress(data))
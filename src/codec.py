@@ -0,0 +1,62 @@
+import json
+import zlib
+
+# Версия формата - первый байт blob'а
+COMPACT_VERSION = 1
+
+# Списки однотипных словарей, которые хранятся по колонкам: имена ключей один раз на список
+COLUMNAR_SECTIONS = ('performance_metrics', 'key_moments')
+
+# Общий словарь для zlib: строки, которые повторяются в каждом анализе.
+# Менять только вместе с COMPACT_VERSION, иначе старые записи не распакуются
+ZDICT = json.dumps([
+    ['player_slot', 'hero_id', 'kills', 'deaths', 'assists', 'gpm', 'xpm',
+     'hero_damage', 'tower_damage', 'hero_healing'],
+    ['time', 'type', 'slot', 'team', 'unit', 'key'],
+    {'draft_analysis': {'radiant_heroes': [], 'dire_heroes': [], 'synergy_score': 50.0,
+                        'dire_synergy_score': 50.0, 'counter_score': 50.0}},
+    ['CHAT_MESSAGE_FIRSTBLOOD', 'CHAT_MESSAGE_ROSHAN_KILL', 'CHAT_MESSAGE_AEGIS', 'building_kill',
+     'CHAT_MESSAGE_COURIER_LOST', 'npc_dota_goodguys_tower', 'npc_dota_badguys_tower',
+     'npc_dota_goodguys_melee_rax', 'npc_dota_badguys_melee_rax', 'npc_dota_hero_'],
+    ['performance_metrics', 'key_moments']
+], separators=(',', ':')).encode()
+
+
+def _to_columns(items):
+    # [{a: 1, b: 2}, {a: 3, b: 4}] -> [[a, b], [[1, 3], [2, 4]]]; None, если ключи у элементов разные
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        return None
+    keys = list(items[0])
+    if any(list(item) != keys for item in items):
+        return None
+    return [keys, [[item[key] for item in items] for key in keys]]
+
+
+def _from_columns(keys, columns):
+    return [dict(zip(keys, values)) for values in zip(*columns)]
+
+
+def encode_analysis(analysis):
+    # Анализ -> байты: колоночные секции + компактный JSON + zlib с общим словарем
+    columnar = {}
+    if isinstance(analysis, dict):
+        for section in COLUMNAR_SECTIONS:
+            columns = _to_columns(analysis.get(section))
+            if columns is not None:
+                columnar[section] = columns
+        if columnar:
+            analysis = {key: (None if key in columnar else value) for key, value in analysis.items()}
+
+    payload = json.dumps([analysis, columnar], separators=(',', ':')).encode()
+    compressor = zlib.compressobj(9, zdict=ZDICT)
+    return bytes([COMPACT_VERSION]) + compressor.compress(payload) + compressor.flush()
+
+
+def decode_analysis(blob):
+    if blob[0] != COMPACT_VERSION:
+        raise ValueError(f"Unknown analysis format version {blob[0]}")
+    decompressor = zlib.decompressobj(zdict=ZDICT)
+    analysis, columnar = json.loads(decompressor.decompress(blob[1:]) + decompressor.flush())
+    for section, (keys, columns) in columnar.items():
+        analysis[section] = _from_columns(keys, columns)
+    return analysis
@@ -0,0 +1,54 @@
+import decimal
+from datetime import date
+
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjson не обязателен: без него работает stdlib json
+    orjson = None
+
+
+class StdlibJSONProvider(DefaultJSONProvider):
+    # Стандартный json: даты в ISO 8601 (как у orjson), порядок ключей не меняем
+    sort_keys = False
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, date):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+
+def _orjson_default(o):
+    # То, что orjson не кодирует сам
+    if isinstance(o, decimal.Decimal):
+        return str(o)
+    if hasattr(o, '__html__'):
+        return str(o.__html__())
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class OrjsonProvider(JSONProvider):
+    # orjson: datetime, UUID и dataclass кодируются нативно, ответ собирается сразу в байты
+    option = orjson.OPT_NON_STR_KEYS if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_orjson_default, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=_orjson_default, option=self.option | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype='application/json')
+
+
+def json_provider_class(name='auto'):
+    # auto - orjson, если установлен; orjson - обязательно orjson; stdlib - стандартный json
+    if name == 'stdlib' or (name == 'auto' and orjson is None):
+        return StdlibJSONProvider
+    if orjson is None:
+        raise RuntimeError('JSON_PROVIDER=orjson requires the orjson package')
+    return OrjsonProvider
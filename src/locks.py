@@ -0,0 +1,20 @@
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессной блокировки нет, только внутри процесса
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path):
+    # Эксклюзивная блокировка между процессами на хосте (flock на файле path);
+    # от потоков своего процесса вызывающий защищается отдельно
+    with open(path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
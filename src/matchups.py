@@ -0,0 +1,221 @@
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+# С запасом под новых героев; матрица растет, если ID не помещается
+DEFAULT_SIZE = 256
+
+
+class MatchupMatrix:
+    # Матрица пар героев: games[i, j] и wins[i, j] - игры и победы героя i против героя j
+    # (или вместе с героем j для матрицы синергий). Винрейты, доверительные интервалы
+    # и контрпики считаются векторно для всех героев сразу
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.games = np.zeros((size, size), dtype=np.int64)
+        self.wins = np.zeros((size, size), dtype=np.int64)
+        self.loaded = np.zeros(size, dtype=bool)  # для каких героев есть данные
+        self._counters = None
+        self._threshold = None
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self.games.shape[0]
+
+    def _ensure_writable(self, hero_id):
+        # Загруженная через mmap матрица только для чтения - копируем при первой записи
+        size = self.size
+        if hero_id >= size:
+            size = max(hero_id + 1, size * 2)
+        if size != self.size or not self.games.flags.writeable:
+            games = np.zeros((size, size), dtype=np.int64)
+            wins = np.zeros((size, size), dtype=np.int64)
+            loaded = np.zeros(size, dtype=bool)
+            old = self.size
+            games[:old, :old] = self.games
+            wins[:old, :old] = self.wins
+            loaded[:old] = self.loaded
+            self.games, self.wins, self.loaded = games, wins, loaded
+
+    def set_row(self, hero_id, matchups):
+        # Строка героя из ответа heroes/{id}/matchups
+        opponents = np.array([m['hero_id'] for m in matchups], dtype=np.int64)
+        with self._lock:
+            self._ensure_writable(max(hero_id, int(opponents.max(initial=0))))
+            self.games[hero_id, :] = 0
+            self.wins[hero_id, :] = 0
+            if len(opponents):
+                self.games[hero_id, opponents] = [m['games_played'] for m in matchups]
+                self.wins[hero_id, opponents] = [m['wins'] for m in matchups]
+            self.loaded[hero_id] = True
+            self._counters = None
+
+    def add_allies(self, heroes, won):
+        # Игра команды: +1 игра (и победа) каждой паре союзников
+        heroes = np.asarray(heroes, dtype=np.int64)
+        if len(heroes) < 2:
+            return
+        with self._lock:
+            self._ensure_writable(int(heroes.max()))
+            rows, cols = np.meshgrid(heroes, heroes, indexing='ij')
+            pairs = rows != cols
+            np.add.at(self.games, (rows[pairs], cols[pairs]), 1)
+            if won:
+                np.add.at(self.wins, (rows[pairs], cols[pairs]), 1)
+            self.loaded[heroes] = True
+            self._counters = None
+
+    def add_pairs(self, heroes, others, games, wins, opposed):
+        # Прибавить игры и победы парам (heroes[i], others[i]) и зеркальным парам.
+        # wins - победы героя heroes[i]; у противников зеркальная пара выигрывает остальные игры
+        heroes = np.asarray(heroes, dtype=np.int64)
+        others = np.asarray(others, dtype=np.int64)
+        if not len(heroes):
+            return
+        games = np.asarray(games, dtype=np.int64)
+        wins = np.asarray(wins, dtype=np.int64)
+        with self._lock:
+            self._ensure_writable(int(max(heroes.max(), others.max())))
+            np.add.at(self.games, (heroes, others), games)
+            np.add.at(self.games, (others, heroes), games)
+            np.add.at(self.wins, (heroes, others), wins)
+            np.add.at(self.wins, (others, heroes), games - wins if opposed else wins)
+            self.loaded[heroes] = True
+            self.loaded[others] = True
+            self._counters = None
+
+    def pair_win_rate(self, team_a, team_b, symmetric=False):
+        # Суммарный винрейт пар (team_a x team_b) в процентах, 50 - если данных нет.
+        # symmetric=False: для пары без своей строки берем обратную (b против a)
+        size = self.size
+        a = np.array([hero for hero in team_a if 0 <= hero < size], dtype=np.int64)
+        b = np.array([hero for hero in team_b if 0 <= hero < size], dtype=np.int64)
+        if not len(a) or not len(b):
+            return 50.0
+
+        cells = np.ix_(a, b)
+        games = self.games[cells].sum()
+        wins = self.wins[cells].sum()
+        if not symmetric:
+            reverse = np.ix_(b, a)
+            games += self.games[reverse].sum()
+            wins += self.games[reverse].sum() - self.wins[reverse].sum()
+        return round(float(wins / games * 100), 2) if games else 50.0
+
+    def has(self, hero_id):
+        return 0 <= hero_id < self.size and bool(self.loaded[hero_id])
+
+    def win_rates(self):
+        # Винрейт в процентах, 0 там, где игр не было
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.games > 0, self.wins / self.games * 100, 0.0)
+
+    def confidence_intervals(self, z=1.96):
+        # Интервал Уилсона для винрейта каждой пары, в процентах
+        n = np.maximum(self.games, 1)
+        p = self.wins / n
+        denominator = 1 + z ** 2 / n
+        center = (p + z ** 2 / (2 * n)) / denominator
+        margin = z * np.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / denominator
+        no_games = self.games == 0
+        low = np.where(no_games, 0.0, (center - margin) * 100)
+        high = np.where(no_games, 100.0, (center + margin) * 100)
+        return low, high
+
+    def derive_counters(self, threshold):
+        # Списки контрпиков для всех героев за один векторный проход
+        rates = self.win_rates()
+        low, high = self.confidence_intervals()
+        mask = (self.games > 0) & (rates > threshold) & self.loaded[:, None]
+
+        rows, cols = np.nonzero(mask)
+        bounds = np.searchsorted(rows, np.arange(self.size + 1))
+        counters = {}
+        for hero_id in np.flatnonzero(self.loaded):
+            opponents = cols[bounds[hero_id]:bounds[hero_id + 1]]
+            counters[int(hero_id)] = [{
+                'hero_id': int(opponent),
+                'win_rate': round(float(rates[hero_id, opponent]), 2),
+                'games': int(self.games[hero_id, opponent]),
+                'ci_low': round(float(low[hero_id, opponent]), 2),
+                'ci_high': round(float(high[hero_id, opponent]), 2)
+            } for opponent in opponents]
+        return counters
+
+    def counters_for(self, hero_id, threshold):
+        # Готовый срез для героя или None, если данных по нему нет
+        if not self.has(hero_id):
+            return None
+        counters = self._counters
+        if counters is None or self._threshold != threshold:
+            with self._lock:
+                counters = self.derive_counters(threshold)
+                self._counters, self._threshold = counters, threshold
+        return counters.get(hero_id, [])
+
+    def clear(self):
+        with self._lock:
+            self.games = np.zeros_like(self.games)
+            self.wins = np.zeros_like(self.wins)
+            self.loaded = np.zeros(self.size, dtype=bool)
+            self._counters = None
+
+    def save(self, path):
+        # Обе матрицы одним .npy; запись через временный файл, чтобы читатели не видели половину
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            data = np.stack([self.games, self.wins])
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        # Матрица с диска через mmap; строки с играми считаются загруженными
+        data = np.load(path, mmap_mode='r')
+        matrix = cls(0)
+        matrix.games, matrix.wins = data[0], data[1]
+        matrix.loaded = np.asarray(matrix.games.sum(axis=1) > 0)
+        return matrix
+
+
+def _pooled_rate(games, wins):
+    # Построчный общий винрейт по парам, 50 там, где игр не было
+    games = games.sum(axis=1)
+    wins = wins.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(games > 0, wins / games * 100, 50.0)
+
+
+def rank_candidates(synergy, matchups, candidates, allies, enemies):
+    # Оценка всех кандидатов за один векторный проход:
+    # синергия с союзниками + преимущество против врагов (оба относительно 50%).
+    # Возвращает (score, synergy, counter) - массивы в порядке candidates
+    size = min(synergy.size, matchups.size)
+    candidates = np.asarray(candidates, dtype=np.int64)
+    in_range = candidates < size
+    allies = np.array([hero for hero in allies if hero < size], dtype=np.int64)
+    enemies = np.array([hero for hero in enemies if hero < size], dtype=np.int64)
+
+    synergy_rate = np.full(len(candidates), 50.0)
+    counter_rate = np.full(len(candidates), 50.0)
+    known = candidates[in_range]
+
+    if len(allies) and len(known):
+        cells = np.ix_(known, allies)
+        synergy_rate[in_range] = _pooled_rate(synergy.games[cells], synergy.wins[cells])
+
+    if len(enemies) and len(known):
+        # Строка кандидата (он против врага) плюс перевернутая строка врага (враг против него)
+        cells, reverse = np.ix_(known, enemies), np.ix_(enemies, known)
+        games = matchups.games[cells] + matchups.games[reverse].T
+        wins = matchups.wins[cells] + (matchups.games[reverse] - matchups.wins[reverse]).T
+        counter_rate[in_range] = _pooled_rate(games, wins)
+
+    score = (synergy_rate - 50) + (counter_rate - 50)
+    return score, synergy_rate, counter_rate
@@ -0,0 +1,68 @@
+from sqlalchemy import inspect, literal, text
+
+from models import db
+
+
+def _column_ddl(column, dialect):
+    # Описание колонки для ALTER TABLE ADD COLUMN; NOT NULL только при скалярном значении по умолчанию
+    ddl = f"{column.name} {column.type.compile(dialect=dialect)}"
+    default = column.default
+    if default is not None and default.is_scalar:
+        value = literal(default.arg, column.type).compile(dialect=dialect, compile_kwargs={'literal_binds': True})
+        ddl += f" DEFAULT {value}"
+        if not column.nullable:
+            ddl += " NOT NULL"
+    return ddl
+
+
+def _deduplicate(conn, table, index):
+    # Перед созданием уникального индекса оставляем по одной (последней) строке на ключ
+    columns = ', '.join(column.name for column in index.columns)
+    result = conn.execute(text(
+        f"DELETE FROM {table.name} WHERE id NOT IN "
+        f"(SELECT MAX(id) FROM {table.name} GROUP BY {columns})"
+    ))
+    return result.rowcount
+
+
+def migrate_schema():
+    # Доводит существующую БД до текущих моделей без drop_all: новые таблицы,
+    # колонки и индексы. Возвращает список выполненных изменений
+    engine = db.engine
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    changes = []
+
+    db.create_all()
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            changes.append(f"created table {table.name}")
+            continue
+
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+
+        with engine.begin() as conn:
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {_column_ddl(column, engine.dialect)}"))
+                changes.append(f"added column {table.name}.{column.name}")
+
+                if table.name == 'hero_counters' and column.name == 'source':
+                    # Строки, рассчитанные по OpenDota до появления source, узнаются по тексту reason
+                    conn.execute(text(
+                        "UPDATE hero_counters SET source = 'computed' WHERE reason LIKE 'High win rate of %'"
+                    ))
+
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                if index.unique and 'id' in table.columns:
+                    removed = _deduplicate(conn, table, index)
+                    if removed:
+                        changes.append(f"removed {removed} duplicate rows from {table.name}")
+                index.create(conn)
+                changes.append(f"created index {index.name}")
+
+    return changes
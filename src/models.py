@@ -1,6 +1,9 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 
+from codec import decode_analysis, encode_analysis
+from timeline import build_moments_index
+
 db = SQLAlchemy()
 
 
@@ -23,12 +26,18 @@ class Hero(db.Model):
 
 class HeroCounter(db.Model):
     __tablename__ = 'hero_counters'
+    __table_args__ = (
+        # Уникальность пары заодно покрывает выборку по hero_id
+        db.Index('uq_hero_counters_pair', 'hero_id', 'counter_hero_id', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     hero_id = db.Column(db.Integer, db.ForeignKey('heroes.id'), nullable=False)
     counter_hero_id = db.Column(db.Integer, db.ForeignKey('heroes.id'), nullable=False)
     win_rate = db.Column(db.Float)
     reason = db.Column(db.Text)
+    source = db.Column(db.String(20), nullable=False, default='manual')  # "manual" или "computed" (из OpenDota)
+    fetched_at = db.Column(db.DateTime)  # когда computed-строка была получена из OpenDota
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     counter_hero = db.relationship('Hero', foreign_keys=[counter_hero_id])
@@ -36,6 +45,9 @@ class HeroCounter(db.Model):
 
 class HeroSynergy(db.Model):
     __tablename__ = 'hero_synergies'
+    __table_args__ = (
+        db.Index('uq_hero_synergies_pair', 'hero_id', 'synergy_hero_id', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     hero_id = db.Column(db.Integer, db.ForeignKey('heroes.id'), nullable=False)
@@ -49,6 +61,9 @@ class HeroSynergy(db.Model):
 
 class HeroBuild(db.Model):
     __tablename__ = 'hero_builds'
+    __table_args__ = (
+        db.Index('ix_hero_builds_hero_votes', 'hero_id', 'votes'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     hero_id = db.Column(db.Integer, db.ForeignKey('heroes.id'), nullable=False)
@@ -67,6 +82,9 @@ class HeroBuild(db.Model):
 
 class BuildComment(db.Model):
     __tablename__ = 'build_comments'
+    __table_args__ = (
+        db.Index('ix_build_comments_build_created', 'build_id', 'created_at'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     build_id = db.Column(db.Integer, db.ForeignKey('hero_builds.id'), nullable=False)
@@ -83,5 +101,102 @@ class MatchAnalysis(db.Model):
     match_id = db.Column(db.BigInteger, nullable=False, unique=True)
     radiant_win = db.Column(db.Boolean)
     duration = db.Column(db.Integer)
-    analysis = db.Column(db.JSON)
+    # Анализ хранится либо JSON (analysis), либо компактным blob'ом (analysis_blob);
+    # снаружи всегда доступен как словарь через свойство analysis
+    analysis_json = db.Column('analysis', db.JSON(none_as_null=True))
+    analysis_blob = db.Column(db.LargeBinary)
+    # Индекс key_moments по времени, типу и команде (см. timeline.py)
+    moments_index = db.Column(db.JSON(none_as_null=True))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Формат новых записей: 'json' или 'compact' (задается из ANALYSIS_STORAGE)
+    storage = 'json'
+
+    @classmethod
+    def encode_columns(cls, analysis, storage=None):
+        # Значения колонок для записи анализа в выбранном формате вместе с индексом моментов
+        moments_index = build_moments_index(analysis.get('key_moments')) if isinstance(analysis, dict) else None
+        if (storage or cls.storage) == 'compact' and analysis is not None:
+            return {'analysis': None, 'analysis_blob': encode_analysis(analysis), 'moments_index': moments_index}
+        return {'analysis': analysis, 'analysis_blob': None, 'moments_index': moments_index}
+
+    @property
+    def analysis(self):
+        if self.analysis_blob is not None:
+            return decode_analysis(self.analysis_blob)
+        return self.analysis_json
+
+    @analysis.setter
+    def analysis(self, value):
+        columns = self.encode_columns(value)
+        self.analysis_json, self.analysis_blob = columns['analysis'], columns['analysis_blob']
+        self.moments_index = columns['moments_index']
+
+
+class FetchLease(db.Model):
+    __tablename__ = 'fetch_leases'
+
+    key = db.Column(db.String(100), primary_key=True)  # например matches/123
+    owner = db.Column(db.String(32), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class AnalysisJob(db.Model):
+    __tablename__ = 'analysis_jobs'
+    __table_args__ = (
+        db.Index('ix_analysis_jobs_match_status', 'match_id', 'status'),
+    )
+
+    id = db.Column(db.String(32), primary_key=True)
+    match_id = db.Column(db.BigInteger, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    error = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class HeroPerformance(db.Model):
+    # Накопительные суммы метрик героя по сохраненным анализам: среднее и дисперсия за O(1).
+    # duration_bucket = -1 - все матчи, иначе номер интервала длительности (см. rollups.py)
+    __tablename__ = 'hero_performance'
+    __table_args__ = (
+        db.Index('uq_hero_performance_bucket', 'hero_id', 'duration_bucket', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    hero_id = db.Column(db.Integer, nullable=False)
+    duration_bucket = db.Column(db.Integer, nullable=False, default=-1)
+    matches = db.Column(db.BigInteger, nullable=False, default=0)
+    kills_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    kills_sq = db.Column(db.BigInteger, nullable=False, default=0)
+    deaths_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    deaths_sq = db.Column(db.BigInteger, nullable=False, default=0)
+    assists_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    assists_sq = db.Column(db.BigInteger, nullable=False, default=0)
+    gpm_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    gpm_sq = db.Column(db.BigInteger, nullable=False, default=0)
+    xpm_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    xpm_sq = db.Column(db.BigInteger, nullable=False, default=0)
+    hero_damage_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    hero_damage_sq = db.Column(db.BigInteger, nullable=False, default=0)
+    tower_damage_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    tower_damage_sq = db.Column(db.BigInteger, nullable=False, default=0)
+    hero_healing_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    hero_healing_sq = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class HeroPairStat(db.Model):
+    # Игры и победы пар героев по сохраненным матчам: relation = 'ally' или 'enemy',
+    # в паре hero_id < other_hero_id, wins - победы героя hero_id
+    __tablename__ = 'hero_pair_stats'
+    __table_args__ = (
+        db.Index('uq_hero_pair_stats_pair', 'hero_id', 'other_hero_id', 'relation', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    hero_id = db.Column(db.Integer, nullable=False)
+    other_hero_id = db.Column(db.Integer, nullable=False)
+    relation = db.Column(db.String(10), nullable=False)
+    games = db.Column(db.BigInteger, nullable=False, default=0)
+    wins = db.Column(db.BigInteger, nullable=False, default=0)
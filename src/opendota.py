@@ -0,0 +1,226 @@
+import logging
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Коды ответа, при которых имеет смысл повторить запрос
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+logger = logging.getLogger(__name__)
+
+
+def endpoint_class(endpoint):
+    # Класс эндпоинта без конкретных ID: matches/123 -> matches/{id}
+    return re.sub(r'(?<=/)\d+(?=/|$)', '{id}', endpoint.strip('/'))
+
+
+class CacheEntry:
+    __slots__ = ('data', 'size', 'expires_at', 'etag', 'last_modified', 'negative')
+
+    def __init__(self, data, size, expires_at, etag=None, last_modified=None, negative=False):
+        self.data = data
+        self.size = size
+        self.expires_at = expires_at
+        self.etag = etag
+        self.last_modified = last_modified
+        self.negative = negative
+
+    def is_fresh(self):
+        return time.monotonic() < self.expires_at
+
+    def validators(self):
+        # Заголовки для условного запроса, чтобы OpenDota могла ответить 304
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    # TTL + LRU кэш ответов по эндпоинту, вытеснение по суммарному размеру тел
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttls=None, default_ttl=300, negative_ttl=60):
+        self.max_bytes = max_bytes
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def ttl_for(self, endpoint):
+        return self.ttls.get(endpoint_class(endpoint), self.default_ttl)
+
+    def get(self, endpoint):
+        # Запись (возможно протухшая) или None; попадание поднимает запись в LRU
+        with self._lock:
+            entry = self._entries.get(endpoint)
+            if entry is not None:
+                self._entries.move_to_end(endpoint)
+            return entry
+
+    def put(self, endpoint, data, size, etag=None, last_modified=None):
+        entry = CacheEntry(data, size, time.monotonic() + self.ttl_for(endpoint), etag, last_modified)
+        self._store(endpoint, entry)
+
+    def put_negative(self, endpoint):
+        # Запоминаем 404 ненадолго, чтобы не дергать апстрим по битому ID
+        entry = CacheEntry(None, 0, time.monotonic() + self.negative_ttl, negative=True)
+        self._store(endpoint, entry)
+
+    def revalidated(self, endpoint):
+        # Ответ 304: данные те же, продлеваем срок жизни
+        with self._lock:
+            entry = self._entries.get(endpoint)
+            if entry is not None:
+                entry.expires_at = time.monotonic() + self.ttl_for(endpoint)
+                self._entries.move_to_end(endpoint)
+
+    def _store(self, endpoint, entry):
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(endpoint, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[endpoint] = entry
+            self._bytes += entry.size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class OpenDotaClient:
+    # Общий клиент OpenDota: пул keep-alive соединений, таймауты и ограниченные ретраи
+
+    def __init__(self, base_url, pool_size=10, connect_timeout=3.05, read_timeout=10,
+                 max_retries=2, backoff=0.5, backoff_max=5.0, cache=None):
+        self.base_url = base_url.rstrip('/')
+        self.cache = cache
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+
+        self.pool_size = pool_size
+        self.session = self._new_session()
+
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def reset_session(self):
+        # Новый пул соединений, например в дочернем процессе после fork:
+        # сокеты родителя использовать нельзя
+        self.session = self._new_session()
+
+    def get(self, endpoint, headers=None):
+        # GET с ретраями; после исчерпания попыток возвращает последний ответ или пробрасывает ошибку
+        url = f"{self.base_url}/{endpoint.lstrip('/')}"
+        key = endpoint_class(endpoint)
+        attempt = 0
+
+        while True:
+            started = time.perf_counter()
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record(key, time.perf_counter() - started, error=True, retry=attempt > 0)
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff_delay(attempt)
+            else:
+                retryable = response.status_code in RETRY_STATUSES
+                self._record(key, time.perf_counter() - started, error=retryable, retry=attempt > 0)
+                if not retryable or attempt >= self.max_retries:
+                    return response
+                delay = self._backoff_delay(attempt, response.headers.get('Retry-After'))
+
+            attempt += 1
+            time.sleep(delay)
+
+    def fetch(self, endpoint):
+        # JSON по эндпоинту через кэш; None, если OpenDota ответила 404
+        entry = self.cache.get(endpoint) if self.cache is not None else None
+        if entry is not None and entry.is_fresh():
+            return entry.data
+
+        stale = entry if entry is not None and not entry.negative else None
+        try:
+            response = self.get(endpoint, headers=stale.validators() if stale else None)
+            if response.status_code == 304 and stale is not None:
+                self.cache.revalidated(endpoint)
+                return stale.data
+            if response.status_code == 404:
+                if self.cache is not None:
+                    self.cache.put_negative(endpoint)
+                return None
+            response.raise_for_status()
+            data = response.json()
+        except requests.RequestException as e:
+            # Апстрим недоступен - лучше отдать протухшие данные, чем ничего
+            if stale is not None:
+                logger.warning(f"Serving stale {endpoint} after OpenDota error: {e}")
+                return stale.data
+            raise
+
+        if self.cache is not None:
+            self.cache.put(endpoint, data, len(response.content),
+                           etag=response.headers.get('ETag'),
+                           last_modified=response.headers.get('Last-Modified'))
+        return data
+
+    def _backoff_delay(self, attempt, retry_after=None):
+        # Экспоненциальная задержка с полным джиттером, Retry-After ограничиваем сверху
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt)))
+
+    def _record(self, key, elapsed, error=False, retry=False):
+        with self._stats_lock:
+            stats = self._stats.setdefault(key, {
+                'calls': 0,
+                'errors': 0,
+                'retries': 0,
+                'total_seconds': 0.0,
+                'max_seconds': 0.0
+            })
+            stats['calls'] += 1
+            stats['errors'] += int(error)
+            stats['retries'] += int(retry)
+            stats['total_seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+
+    def stats(self):
+        # Снимок счетчиков по классам эндпоинтов
+        with self._stats_lock:
+            result = {}
+            for key, stats in self._stats.items():
+                result[key] = dict(stats)
+                result[key]['avg_seconds'] = stats['total_seconds'] / stats['calls'] if stats['calls'] else 0.0
+            return result
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats.clear()
@@ -0,0 +1,94 @@
+import hashlib
+import threading
+from collections import namedtuple
+from datetime import datetime
+from types import MappingProxyType
+
+from models import db, Hero
+
+# Компактная неизменяемая запись о герое
+HeroRecord = namedtuple('HeroRecord', ['id', 'name', 'localized_name', 'primary_attr', 'attack_type', 'roles',
+                                       'updated_at'])
+
+# Ключ справочника в общем кэше воркеров
+SHARED_KEY = 'heroes'
+
+
+def record_etag(value):
+    # Строгий ETag по содержимому неизменяемой записи (или кортежа записей)
+    return hashlib.sha1(repr(value).encode()).hexdigest()[:20]
+
+
+class HeroRegistry:
+    # Справочник героев на процесс: грузится из БД один раз, сбрасывается при init-db.
+    # shared - функция, возвращающая SharedCache (или None): через него справочник
+    # делят воркеры на хосте, и сброс в одном процессе виден во всех остальных
+
+    def __init__(self, shared=None):
+        self._state = None
+        self._lock = threading.Lock()
+        self._shared = shared
+
+    def _shared_cache(self):
+        return self._shared() if self._shared is not None else None
+
+    def _snapshot(self):
+        # (кортеж героев, словарь по id, ETag, версия в общем кэше, время последнего изменения);
+        # чтение без блокировки
+        # на горячем пути - сверка версии читает только общую память
+        state = self._state
+        shared = self._shared_cache()
+        version = shared.version(SHARED_KEY) if shared is not None else None
+        if state is None or state[3] != version:
+            with self._lock:
+                state = self._state
+                if state is None or state[3] != version:
+                    state = self._load(shared, version)
+        return state
+
+    def _load(self, shared, version):
+        rows = shared.get(SHARED_KEY) if shared is not None else None
+        if rows is not None and all(len(row) == len(HeroRecord._fields) for row in rows):
+            # В общем кэше время изменения хранится строкой ISO 8601
+            rows = [row[:-1] + [datetime.fromisoformat(row[-1]) if row[-1] else None] for row in rows]
+        else:
+            rows = [list(row) for row in db.session.execute(
+                db.select(Hero.id, Hero.name, Hero.localized_name, Hero.primary_attr, Hero.attack_type, Hero.roles,
+                          Hero.updated_at)
+                .order_by(Hero.id)
+            ).tuples()]
+            if rows and shared is not None:
+                shared.put(SHARED_KEY, [row[:-1] + [row[-1].isoformat() if row[-1] else None] for row in rows],
+                           version)
+        heroes = tuple(
+            HeroRecord(hero_id, name, localized_name, primary_attr, attack_type, tuple(roles or ()), updated_at)
+            for hero_id, name, localized_name, primary_attr, attack_type, roles, updated_at in rows
+        )
+        last_modified = max((hero.updated_at for hero in heroes if hero.updated_at is not None), default=None)
+        state = (heroes, MappingProxyType({hero.id: hero for hero in heroes}), record_etag(heroes), version,
+                 last_modified)
+        # Пустую таблицу не запоминаем: героев еще не загрузили через init-db
+        if heroes:
+            self._state = state
+        return state
+
+    def all(self):
+        return self._snapshot()[0]
+
+    def get(self, hero_id):
+        return self._snapshot()[1].get(hero_id)
+
+    def etag(self):
+        # Версия справочника целиком: меняется только при перезагрузке героев
+        return self._snapshot()[2]
+
+    def last_modified(self):
+        # Самое позднее updated_at среди героев (None, если времени изменения нет)
+        return self._snapshot()[4]
+
+    def invalidate(self):
+        with self._lock:
+            self._state = None
+        shared = self._shared_cache()
+        if shared is not None:
+            shared.bump(SHARED_KEY)
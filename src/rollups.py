@@ -0,0 +1,189 @@
+import math
+from bisect import bisect_right
+from collections import defaultdict
+
+from sqlalchemy import bindparam
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, HeroPairStat, HeroPerformance, MatchAnalysis
+
+# Метрики из performance_metrics, по которым копятся суммы и суммы квадратов
+PERFORMANCE_METRICS = ('kills', 'deaths', 'assists', 'gpm', 'xpm', 'hero_damage', 'tower_damage', 'hero_healing')
+
+# Границы интервалов длительности матча в минутах: <20, 20-30, 30-40, 40-50, 50+
+DURATION_BUCKETS = (20, 30, 40, 50)
+ALL_DURATIONS = -1
+
+COUNTER_COLUMNS = ('matches',) + tuple(
+    f"{metric}_{suffix}" for metric in PERFORMANCE_METRICS for suffix in ('sum', 'sq')
+)
+
+
+def duration_bucket(duration):
+    return bisect_right(DURATION_BUCKETS, duration / 60) if isinstance(duration, (int, float)) else None
+
+
+def bucket_bounds(bucket):
+    # (от, до) в минутах; None - без границы
+    low = DURATION_BUCKETS[bucket - 1] if bucket > 0 else None
+    high = DURATION_BUCKETS[bucket] if bucket < len(DURATION_BUCKETS) else None
+    return low, high
+
+
+def snapshot(match_analysis):
+    # То, что влияет на сводку: анализ и длительность (копия на момент вызова)
+    return match_analysis.analysis, match_analysis.duration
+
+
+def _as_int(value):
+    return int(round(value)) if isinstance(value, (int, float)) and not isinstance(value, bool) else 0
+
+
+def performance_deltas(added=(), removed=()):
+    # Приращения счетчиков по (hero_id, bucket) для добавленных и убранных снимков анализов
+    deltas = defaultdict(lambda: dict.fromkeys(COUNTER_COLUMNS, 0))
+    for sign, snapshots in ((1, added), (-1, removed)):
+        for analysis, duration in snapshots:
+            metrics = analysis.get('performance_metrics') if isinstance(analysis, dict) else None
+            if not isinstance(metrics, list):
+                continue
+            bucket = duration_bucket(duration)
+            for player in metrics:
+                if not isinstance(player, dict) or not isinstance(player.get('hero_id'), int):
+                    continue
+                for key in ((player['hero_id'], ALL_DURATIONS), (player['hero_id'], bucket)):
+                    if key[1] is None:
+                        continue
+                    delta = deltas[key]
+                    delta['matches'] += sign
+                    for metric in PERFORMANCE_METRICS:
+                        value = _as_int(player.get(metric))
+                        delta[f"{metric}_sum"] += sign * value
+                        delta[f"{metric}_sq"] += sign * value * value
+    return {key: delta for key, delta in deltas.items() if any(delta.values())}
+
+
+def update_hero_performance(added=(), removed=()):
+    # Инкрементальное обновление сводки в текущей транзакции (коммит - на вызывающем)
+    deltas = performance_deltas(added, removed)
+    if not deltas:
+        return 0
+
+    rows = [{'hero_id': hero_id, 'duration_bucket': bucket, **delta} for (hero_id, bucket), delta in deltas.items()]
+    return increment_rows(HeroPerformance.__table__, ('hero_id', 'duration_bucket'), COUNTER_COLUMNS, rows)
+
+
+def increment_rows(table, keys, counters, rows):
+    # Прибавить счетчики к строкам с ключом keys, недостающие строки создать.
+    # Выполняется в текущей транзакции (коммит - на вызывающем)
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        # Один executemany upsert с атомарным прибавлением
+        insert = (sqlite if dialect == 'sqlite' else postgresql).insert(table)
+        db.session.execute(
+            insert.on_conflict_do_update(
+                index_elements=list(keys),
+                set_={column: table.c[column] + insert.excluded[column] for column in counters}
+            ),
+            rows
+        )
+        return len(rows)
+
+    existing = set(db.session.execute(
+        db.select(*(table.c[key] for key in keys))
+        .where(table.c[keys[0]].in_({row[keys[0]] for row in rows}))
+    ).tuples())
+    updates = [row for row in rows if tuple(row[key] for key in keys) in existing]
+    inserts = [row for row in rows if tuple(row[key] for key in keys) not in existing]
+    if updates:
+        db.session.execute(
+            table.update()
+            .where(*(table.c[key] == bindparam(f"b_{key}") for key in keys))
+            .values({column: table.c[column] + bindparam(f"d_{column}") for column in counters}),
+            [{**{f"b_{key}": row[key] for key in keys}, **{f"d_{column}": row[column] for column in counters}}
+             for row in updates]
+        )
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+    return len(rows)
+
+
+def match_pairs(radiant, dire, radiant_win):
+    # Пары героев одного матча: 25 пар противников и 20 пар союзников (по 10 на команду).
+    # В паре hero_id < other_hero_id, wins - победы героя hero_id
+    heroes = list(radiant) + list(dire)
+    if not isinstance(radiant_win, bool) or len(radiant) != 5 or len(set(heroes)) != 10 \
+            or not all(isinstance(hero, int) and hero > 0 for hero in heroes):
+        return []
+    rows = []
+    for team, won in ((radiant, radiant_win), (dire, not radiant_win)):
+        for i, hero in enumerate(team):
+            for other in team[i + 1:]:
+                rows.append(_pair(hero, other, 'ally', won))
+    for hero in radiant:
+        for other in dire:
+            rows.append(_pair(hero, other, 'enemy', radiant_win))
+    return rows
+
+
+def _pair(hero, other, relation, hero_won):
+    if hero > other:
+        hero, other = other, hero
+        hero_won = hero_won if relation == 'ally' else not hero_won
+    return {'hero_id': hero, 'other_hero_id': other, 'relation': relation, 'games': 1, 'wins': int(hero_won)}
+
+
+def update_pair_stats(rows):
+    # Пары героев из новых матчей - одним пакетным upsert
+    if not rows:
+        return 0
+    merged = {}
+    for row in rows:
+        key = (row['hero_id'], row['other_hero_id'], row['relation'])
+        if key in merged:
+            merged[key]['games'] += row['games']
+            merged[key]['wins'] += row['wins']
+        else:
+            merged[key] = dict(row)
+    return increment_rows(HeroPairStat.__table__, ('hero_id', 'other_hero_id', 'relation'),
+                          ('games', 'wins'), list(merged.values()))
+
+
+def rebuild_hero_performance(batch_size=1000):
+    # Полный пересчет сводки по всем сохраненным анализам (после reanalyze или для старых данных)
+    totals = defaultdict(lambda: dict.fromkeys(COUNTER_COLUMNS, 0))
+    last_id = matches = 0
+    while True:
+        rows = db.session.execute(
+            db.select(MatchAnalysis).where(MatchAnalysis.id > last_id).order_by(MatchAnalysis.id).limit(batch_size)
+        ).scalars().all()
+        if not rows:
+            break
+        for key, delta in performance_deltas(added=[snapshot(row) for row in rows]).items():
+            for column, value in delta.items():
+                totals[key][column] += value
+        last_id = rows[-1].id
+        matches += len(rows)
+        db.session.expunge_all()
+
+    db.session.execute(db.delete(HeroPerformance))
+    if totals:
+        db.session.execute(HeroPerformance.__table__.insert(), [
+            {'hero_id': hero_id, 'duration_bucket': bucket, **values}
+            for (hero_id, bucket), values in totals.items()
+        ])
+    return matches
+
+
+def summarize(row):
+    # Средние и стандартные отклонения из накопленных сумм
+    n = row.matches
+    metrics = {}
+    for metric in PERFORMANCE_METRICS:
+        total, squares = getattr(row, f"{metric}_sum"), getattr(row, f"{metric}_sq")
+        variance = (squares - total * total / n) / (n - 1) if n > 1 else 0.0
+        metrics[metric] = {
+            'avg': round(total / n, 2),
+            'stddev': round(math.sqrt(max(variance, 0.0)), 2)
+        }
+    return {'matches': n, 'metrics': metrics}
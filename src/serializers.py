@@ -0,0 +1,69 @@
+# Представление моделей в ответах API. Принимают ORM-объекты и строки выборок по колонкам;
+# даты остаются datetime - их кодирует JSON-провайдер приложения (см. jsonprovider.py)
+
+
+def serialize_hero(hero):
+    return {
+        'id': hero.id,
+        'name': hero.name,
+        'localized_name': hero.localized_name,
+        'primary_attr': hero.primary_attr,
+        'attack_type': hero.attack_type,
+        'roles': list(hero.roles or ())
+    }
+
+
+def serialize_counter(counter, counter_hero_name=None):
+    return {
+        'id': counter.id,
+        'hero_id': counter.hero_id,
+        'counter_hero_id': counter.counter_hero_id,
+        'counter_hero_name': counter_hero_name,
+        'win_rate': counter.win_rate,
+        'reason': counter.reason,
+        'source': counter.source,
+        'fetched_at': counter.fetched_at
+    }
+
+
+def serialize_build(build):
+    return {
+        'id': build.id,
+        'hero_id': build.hero_id,
+        'name': build.name,
+        'description': build.description,
+        'items': build.items,
+        'skills': build.skills,
+        'talents': build.talents,
+        'playstyle': build.playstyle,
+        'votes': build.votes,
+        'created_at': build.created_at,
+        'updated_at': build.updated_at
+    }
+
+
+def serialize_comment(comment):
+    return {
+        'id': comment.id,
+        'build_id': comment.build_id,
+        'author': comment.author,
+        'content': comment.content,
+        'rating': comment.rating,
+        'created_at': comment.created_at
+    }
+
+
+def serialize_match_analysis(analysis, sections=None):
+    # sections - оставить в анализе только эти секции (в заданном порядке)
+    data = analysis.analysis
+    if sections is not None:
+        data = data if isinstance(data, dict) else {}
+        data = {name: data[name] for name in sections if name in data}
+    return {
+        'match_id': analysis.match_id,
+        'radiant_win': analysis.radiant_win,
+        'duration': analysis.duration,
+        'analysis': data,
+        'created_at': analysis.created_at,
+        'updated_at': analysis.updated_at
+    }
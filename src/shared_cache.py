@@ -0,0 +1,89 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+from locks import file_lock
+
+# Слот 0 - общая эпоха (сбрасывает все ключи), остальные - счетчики версий по хэшу ключа
+SLOTS = 1024
+SLOT = struct.Struct('<Q')
+
+
+class SharedCache:
+    # Кэш для всех воркеров на хосте: версии ключей лежат в общем mmap-файле,
+    # значения - в файлах рядом. Запись в БД увеличивает версию ключа (bump),
+    # и остальные процессы видят это при следующем чтении без запроса к БД
+
+    def __init__(self, directory, dumps=json.dumps):
+        self.directory = directory
+        self.dumps = dumps
+        self._memo = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        self._versions_path = os.path.join(directory, 'versions.bin')
+        fd = os.open(self._versions_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            with self._file_lock():
+                if os.fstat(fd).st_size < SLOTS * SLOT.size:
+                    os.ftruncate(fd, SLOTS * SLOT.size)
+            self._versions = mmap.mmap(fd, SLOTS * SLOT.size)
+        finally:
+            os.close(fd)
+
+    def _file_lock(self):
+        return file_lock(os.path.join(self.directory, 'lock'))
+
+    def _slot(self, key):
+        # Коллизия хэшей безопасна: лишняя инвалидация соседнего ключа
+        return 1 + zlib.crc32(key.encode()) % (SLOTS - 1)
+
+    def version(self, key):
+        # Текущая версия ключа: чтение из общей памяти, без системных вызовов
+        return (SLOT.unpack_from(self._versions, 0)[0],
+                SLOT.unpack_from(self._versions, self._slot(key) * SLOT.size)[0])
+
+    def bump(self, key=None):
+        # Новая версия ключа (None - всех ключей сразу); вызывать после коммита в БД.
+        # Возвращает версию ключа сразу после увеличения
+        offset = self._slot(key) * SLOT.size if key is not None else 0
+        with self._lock, self._file_lock():
+            SLOT.pack_into(self._versions, offset, SLOT.unpack_from(self._versions, offset)[0] + 1)
+            return self.version(key) if key is not None else None
+
+    def _path(self, key):
+        return os.path.join(self.directory, key.replace('/', '_') + '.json')
+
+    def get(self, key):
+        # Значение актуальной версии или None; разобранное значение запоминается в процессе
+        version = self.version(key)
+        memo = self._memo.get(key)
+        if memo is not None and memo[0] == version:
+            return memo[1]
+        try:
+            with open(self._path(key), 'rb') as f:
+                header = f.readline()
+                if tuple(json.loads(header)) != version:
+                    return None
+                value = json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+        self._memo[key] = (version, value)
+        return value
+
+    def put(self, key, value, version):
+        # version - версия, прочитанная до выборки из БД: если с тех пор ключ
+        # инвалидировали, значение уже устарело и не сохраняется
+        if self.version(key) != version:
+            return False
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(list(version)).encode() + b'\n')
+            f.write(self.dumps(value).encode())
+        os.replace(tmp_path, self._path(key))
+        self._memo[key] = (version, value)
+        return True
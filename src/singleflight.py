@@ -0,0 +1,99 @@
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, FetchLease
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # Схлопывание одновременных вызовов с одним ключом внутри процесса:
+    # первый выполняет работу, остальные ждут его результат
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if not call.done.wait(self.timeout):
+                raise TimeoutError(f"Timed out waiting for in-flight {key}")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+
+def acquire_lease(key, ttl):
+    # Аренда ключа в БД для координации между процессами; None, если ключ уже занят
+    owner = uuid.uuid4().hex
+    now = datetime.utcnow()
+    try:
+        # Аренду упавшего владельца можно забрать после истечения срока
+        db.session.execute(db.delete(FetchLease).where(FetchLease.key == key, FetchLease.expires_at < now))
+        db.session.execute(db.insert(FetchLease).values(key=key, owner=owner, expires_at=now + timedelta(seconds=ttl)))
+        db.session.commit()
+        return owner
+    except IntegrityError:
+        db.session.rollback()
+        return None
+
+
+def release_lease(key, owner):
+    db.session.execute(db.delete(FetchLease).where(FetchLease.key == key, FetchLease.owner == owner))
+    db.session.commit()
+
+
+def lease_flight(key, lookup, produce, ttl=30, wait=30, poll=0.05):
+    # Межпроцессный single-flight: lookup ищет готовый результат (None - нет),
+    # produce выполняет выборку и запись под арендой ключа.
+    # Вызывающий код уже проверил lookup до входа
+    deadline = time.monotonic() + wait
+    while True:
+        owner = acquire_lease(key, ttl)
+        if owner is not None:
+            try:
+                # Пока брали аренду, другой процесс мог успеть записать результат
+                result = lookup()
+                return result if result is not None else produce()
+            except BaseException:
+                db.session.rollback()
+                raise
+            finally:
+                release_lease(key, owner)
+
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Timed out waiting for lease on {key}")
+        time.sleep(poll)
+
+        result = lookup()
+        if result is not None:
+            return result
@@ -0,0 +1,49 @@
+from bisect import bisect_left, bisect_right
+
+# Пустой срез индекса: [времена, позиции]
+EMPTY = ([], [])
+
+
+def _add(entry, time, position):
+    entry[0].append(time)
+    entry[1].append(position)
+
+
+def build_moments_index(key_moments):
+    # Индекс ключевых моментов: для всех моментов, каждого типа и каждой команды -
+    # отсортированные времена и параллельные позиции в key_moments. Строится один раз при записи
+    if not isinstance(key_moments, list):
+        return None
+    timeline = sorted(
+        (moment['time'], position) for position, moment in enumerate(key_moments)
+        if isinstance(moment, dict) and isinstance(moment.get('time'), (int, float))
+    )
+    index = {'all': [[], []], 'types': {}, 'teams': {}}
+    for time, position in timeline:
+        moment = key_moments[position]
+        _add(index['all'], time, position)
+        _add(index['types'].setdefault(str(moment.get('type')), [[], []]), time, position)
+        _add(index['teams'].setdefault(str(moment.get('team')), [[], []]), time, position)
+    return index
+
+
+def query_moments(key_moments, index, start=None, end=None, moment_type=None, team=None):
+    # Моменты в [start, end] с фильтром по типу и команде: бинарный поиск по самому короткому срезу
+    candidates = [index['all']]
+    if moment_type is not None:
+        candidates.append(index['types'].get(moment_type, EMPTY))
+    if team is not None:
+        candidates.append(index['teams'].get(str(team), EMPTY))
+    times, positions = min(candidates, key=lambda entry: len(entry[0]))
+
+    low = bisect_left(times, start) if start is not None else 0
+    high = bisect_right(times, end) if end is not None else len(times)
+    moments = []
+    for position in positions[low:high]:
+        moment = key_moments[position]
+        if moment_type is not None and str(moment.get('type')) != moment_type:
+            continue
+        if team is not None and str(moment.get('team')) != str(team):
+            continue
+        moments.append(moment)
+    return moments
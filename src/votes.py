@@ -0,0 +1,58 @@
+import logging
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+class VoteAggregator:
+    # Write-behind буфер голосов: инкременты копятся в памяти по сборкам
+    # и раз в interval секунд сбрасываются одним пакетным UPDATE
+
+    def __init__(self, flush, interval=0.05):
+        self._flush = flush
+        self.interval = interval
+        self._pending = defaultdict(int)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, build_id, delta):
+        # Возвращает суммарный еще не записанный прирост для сборки
+        with self._lock:
+            self._pending[build_id] += delta
+            pending = self._pending[build_id]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='vote-flusher', daemon=True)
+                self._thread.start()
+        return pending
+
+    def pending(self, build_id):
+        with self._lock:
+            return self._pending.get(build_id, 0)
+
+    def flush(self):
+        with self._lock:
+            batch = {build_id: delta for build_id, delta in self._pending.items() if delta}
+            self._pending.clear()
+        if not batch:
+            return 0
+
+        try:
+            self._flush(batch)
+        except Exception as e:
+            # Не теряем голоса: возвращаем пачку в буфер до следующей попытки
+            logger.error(f"Error flushing votes: {e}")
+            with self._lock:
+                for build_id, delta in batch.items():
+                    self._pending[build_id] += delta
+            return 0
+        return len(batch)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
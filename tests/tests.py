@@ -2,18 +2,52 @@ import pytest
 import json
 import sys
 import os
+import requests
+import requests_mock
+from contextlib import contextmanager
+from datetime import timezone
 from unittest.mock import patch
+from sqlalchemy import event
+from werkzeug.http import http_date
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
-from app import app, db, Hero, HeroCounter, HeroSynergy, HeroBuild, BuildComment, MatchAnalysis
+import app as app_module
+from app import app, opendota, hero_registry, matchup_matrix, db, Hero, HeroCounter, HeroSynergy, HeroBuild, BuildComment, MatchAnalysis, HeroPairStat
+from opendota import OpenDotaClient, ResponseCache, endpoint_class
+
+
+@contextmanager
+def count_queries():
+    # Подсчет SQL-запросов, выполненных внутри блока
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
 
 
 @pytest.fixture
-def client():
+def client(tmp_path):
     # Фикстура для тестового клиента
     app.config['TESTING'] = True
+    app.config['MATCHUP_MATRIX_PATH'] = str(tmp_path / 'matchups.npy')
+    app.config['SYNERGY_MATRIX_PATH'] = str(tmp_path / 'synergies.npy')
+    app.config['MATCH_ARCHIVE_DIR'] = str(tmp_path / 'match_archive')
+    app.config['SHARED_CACHE_DIR'] = str(tmp_path / 'shared_cache')
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+    opendota.cache.clear()
+    matchup_matrix.clear()
+    app_module.synergy_matrix.clear()
+    app_module.reset_local_pair_matrices()
+
     with app.test_client() as client:
         with app.app_context():
             db.create_all()
@@ -95,6 +129,7 @@ def init_database(client):
         db.session.add(match_analysis)
 
         db.session.commit()
+        hero_registry.invalidate()
 
         yield
 
@@ -400,3 +435,1121 @@ def test_get_nonexistent_match_analysis(mock_fetch, client, init_database):
 
     response = client.get('/api/matches/9999999999')
     assert response.status_code == 404
+
+
+def test_opendota_client_retries_and_stats():
+    # Тест ретраев клиента OpenDota и счетчиков по эндпоинтам
+    client = OpenDotaClient('https://api.opendota.com/api', max_retries=2, backoff=0,
+                            connect_timeout=1, read_timeout=2)
+
+    with requests_mock.Mocker() as m:
+        m.get('https://api.opendota.com/api/matches/42', [
+            {'status_code': 503},
+            {'status_code': 200, 'json': {'match_id': 42}}
+        ])
+        response = client.get('matches/42')
+
+        assert response.json() == {'match_id': 42}
+        assert m.call_count == 2
+        assert m.last_request.timeout == (1, 2)
+
+    stats = client.stats()['matches/{id}']
+    assert stats['calls'] == 2
+    assert stats['errors'] == 1
+    assert stats['retries'] == 1
+
+
+def test_opendota_client_gives_up_after_retries():
+    # Тест ограничения числа ретраев
+    client = OpenDotaClient('https://api.opendota.com/api', max_retries=1, backoff=0)
+
+    with requests_mock.Mocker() as m:
+        m.get('https://api.opendota.com/api/heroes', exc=requests.ConnectTimeout)
+        with pytest.raises(requests.ConnectTimeout):
+            client.get('heroes')
+        assert m.call_count == 2
+
+    assert endpoint_class('heroes/12/matchups') == 'heroes/{id}/matchups'
+
+
+def test_opendota_cache_revalidates_with_etag():
+    # Тест условной ревалидации протухшей записи кэша
+    cache = ResponseCache(ttls={'heroes': 0})
+    client = OpenDotaClient('https://api.opendota.com/api', backoff=0, cache=cache)
+
+    with requests_mock.Mocker() as m:
+        m.get('https://api.opendota.com/api/heroes', [
+            {'status_code': 200, 'json': [{'id': 1}], 'headers': {'ETag': '"v1"'}},
+            {'status_code': 304}
+        ])
+        assert client.fetch('heroes') == [{'id': 1}]
+        assert client.fetch('heroes') == [{'id': 1}]
+        assert m.request_history[1].headers['If-None-Match'] == '"v1"'
+
+
+def test_opendota_cache_remembers_missing_match():
+    # Тест негативного кэширования 404
+    client = OpenDotaClient('https://api.opendota.com/api', backoff=0, cache=ResponseCache())
+
+    with requests_mock.Mocker() as m:
+        m.get('https://api.opendota.com/api/matches/1', status_code=404)
+        assert client.fetch('matches/1') is None
+        assert client.fetch('matches/1') is None
+        assert m.call_count == 1
+
+
+def test_opendota_cache_evicts_by_size():
+    # Тест LRU-вытеснения по суммарному размеру
+    cache = ResponseCache(max_bytes=100)
+    cache.put('matches/1', {'a': 1}, 60)
+    cache.put('matches/2', {'b': 2}, 30)
+    cache.get('matches/1')
+    cache.put('matches/3', {'c': 3}, 30)
+
+    assert cache.get('matches/2') is None
+    assert cache.get('matches/1') is not None
+    assert cache.get('matches/3') is not None
+
+
+def test_hero_registry_serves_without_db(client, init_database):
+    # Тест: после загрузки реестра герои читаются без обращения к БД
+    assert len(json.loads(client.get('/api/heroes').data)) == 2
+
+    with app.app_context():
+        BuildComment.query.delete()
+        HeroBuild.query.delete()
+        HeroCounter.query.delete()
+        Hero.query.delete()
+        db.session.commit()
+
+    response = client.get('/api/heroes/1')
+    assert response.status_code == 200
+    assert json.loads(response.data)['roles'] == ['Carry', 'Escape', 'Nuker']
+
+    hero_registry.invalidate()
+    assert client.get('/api/heroes/1').status_code == 404
+
+
+def test_list_endpoints_use_fixed_query_count(client, init_database):
+    # Тест: число запросов к БД не зависит от размера выдачи
+    client.get('/api/heroes')
+
+    def list_query_counts():
+        counts = []
+        for url in ('/api/heroes/1/counters', '/api/heroes/1/builds', '/api/builds/1/comments'):
+            with count_queries() as statements:
+                assert client.get(url).status_code == 200
+            counts.append(len(statements))
+        return counts
+
+    small = list_query_counts()
+
+    with app.app_context():
+        for i in range(20):
+            db.session.add(Hero(id=100 + i, name=f"npc_dota_hero_{i}", localized_name=f"Hero {i}"))
+            db.session.add(HeroCounter(hero_id=1, counter_hero_id=100 + i, win_rate=50 + i))
+            db.session.add(HeroBuild(hero_id=1, name=f"Build {i}", items=[1], skills=[1]))
+            db.session.add(BuildComment(build_id=1, author=f"User {i}", content="text"))
+        db.session.commit()
+    # Запись в обход API: сбрасываем общий кэш контрпиков, как это делают маршруты
+    app_module.invalidate_counters([1])
+
+    assert list_query_counts() == small
+
+
+@patch('app.fetch_opendota_data')
+def test_computed_counters_are_not_requeried(mock_fetch, client, init_database):
+    # Тест: свежие контрпики вставляются одной пачкой без повторного SELECT
+    mock_fetch.return_value = [
+        {'hero_id': 2, 'games_played': 100, 'wins': 60},
+        {'hero_id': 1, 'games_played': 100, 'wins': 70}
+    ]
+    client.get('/api/heroes')
+
+    with app.app_context():
+        HeroCounter.query.delete()
+        db.session.commit()
+
+    with count_queries() as statements:
+        response = client.get('/api/heroes/1/counters')
+
+    data = json.loads(response.data)
+    assert {counter['counter_hero_id'] for counter in data} == {1, 2}
+    assert data[0]['counter_hero_name'] is not None
+    inserted = next(i for i, statement in enumerate(statements) if statement.startswith('INSERT INTO hero_counters'))
+    assert not any('FROM hero_counters' in statement for statement in statements[inserted:])
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    # Тест: одновременные вызовы с одним ключом выполняют работу один раз
+    import threading
+    import time
+    from singleflight import SingleFlight
+
+    flight = SingleFlight(timeout=5)
+    calls = []
+    barrier = threading.Barrier(8)
+    results = []
+
+    def work():
+        calls.append(1)
+        time.sleep(0.2)
+        return {'match_id': 1}
+
+    def worker():
+        barrier.wait()
+        results.append(flight.do('matches/1', work))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [{'match_id': 1}] * 8
+
+
+def test_fetch_lease_is_exclusive(client, init_database):
+    # Тест аренды в БД: второй владелец не получает занятый ключ
+    from datetime import datetime, timedelta
+    from models import FetchLease
+    from singleflight import acquire_lease, release_lease
+
+    with app.app_context():
+        owner = acquire_lease('matches/1', ttl=30)
+        assert owner is not None
+        assert acquire_lease('matches/1', ttl=30) is None
+
+        release_lease('matches/1', owner)
+        owner = acquire_lease('matches/1', ttl=30)
+        assert owner is not None
+
+        # Протухшую аренду можно перехватить
+        db.session.get(FetchLease, 'matches/1').expires_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        assert acquire_lease('matches/1', ttl=30) not in (None, owner)
+
+
+@patch('app.schedule_counter_refresh')
+def test_stale_counters_served_and_refreshed_in_background(mock_schedule, client, init_database):
+    # Тест: устаревшие computed-контрпики отдаются сразу, обновление уходит в фон
+    from datetime import datetime, timedelta
+
+    with app.app_context():
+        db.session.add(HeroCounter(hero_id=1, counter_hero_id=1, win_rate=55.0, source='computed',
+                                   fetched_at=datetime.utcnow() - timedelta(days=30)))
+        db.session.commit()
+
+    response = client.get('/api/heroes/1/counters')
+    assert response.status_code == 200
+    assert {counter['source'] for counter in json.loads(response.data)} == {'manual', 'computed'}
+    mock_schedule.assert_called_once_with(1)
+
+
+@patch('app.fetch_opendota_data')
+def test_refresh_hero_counters_keeps_manual_rows(mock_fetch, client, init_database):
+    # Тест фонового обновления: computed-строки заменяются, ручные остаются
+    from app import refresh_hero_counters
+
+    mock_fetch.return_value = [
+        {'hero_id': 1, 'games_played': 100, 'wins': 60},
+        {'hero_id': 2, 'games_played': 100, 'wins': 70}
+    ]
+
+    with app.app_context():
+        db.session.add(HeroCounter(hero_id=1, counter_hero_id=1, win_rate=54.0, source='computed'))
+        db.session.commit()
+
+        assert refresh_hero_counters(1)
+
+        counters = HeroCounter.query.filter_by(hero_id=1).order_by(HeroCounter.counter_hero_id).all()
+        assert [(c.counter_hero_id, c.source, c.win_rate) for c in counters] == [
+            (1, 'computed', 60.0),
+            (2, 'manual', 65.5)
+        ]
+        assert counters[0].fetched_at is not None
+
+
+@patch('app.fetch_opendota_data')
+def test_warm_counters_command(mock_fetch, client, init_database):
+    # Тест прогрева контрпиков для всех героев
+    mock_fetch.side_effect = lambda endpoint: {
+        'heroes/1/matchups': [{'hero_id': 2, 'games_played': 100, 'wins': 60}],
+        'heroes/2/matchups': [{'hero_id': 1, 'games_played': 100, 'wins': 70}]
+    }[endpoint]
+
+    result = app.test_cli_runner().invoke(args=['warm-counters', '--workers', '2', '--batch-size', '1'])
+    assert result.exit_code == 0
+    assert 'Warmed counters for 2 heroes' in result.output
+
+    with app.app_context():
+        rows = HeroCounter.query.order_by(HeroCounter.hero_id, HeroCounter.counter_hero_id).all()
+        assert [(c.hero_id, c.counter_hero_id, c.source) for c in rows] == [
+            (1, 2, 'manual'),
+            (2, 1, 'computed')
+        ]
+
+
+def test_add_existing_counter_pair_updates_it(client, init_database):
+    # Тест: пара (герой, контрпик) уникальна, повторный POST обновляет запись
+    response = client.post('/api/heroes/1/counters',
+                           data=json.dumps({'counter_hero_id': 2, 'win_rate': 71.0}),
+                           content_type='application/json')
+    assert response.status_code == 201
+    assert json.loads(response.data)['id'] == 1
+
+    with app.app_context():
+        assert HeroCounter.query.filter_by(hero_id=1, counter_hero_id=2).count() == 1
+
+    # id контрпика строкой приводится к числу и обновляет ту же пару; не число - 400
+    response = client.post('/api/heroes/1/counters', json={'counter_hero_id': '2', 'win_rate': 72.0})
+    assert response.status_code == 201
+    assert json.loads(response.data)['id'] == 1
+    for counter_hero_id in ([2], 'two', None):
+        response = client.post('/api/heroes/1/counters', json={'counter_hero_id': counter_hero_id})
+        assert response.status_code == 400
+
+
+def test_list_queries_use_indexes(client, init_database):
+    # Тест: выборки списков идут по индексам, без полного сканирования и сортировки
+    def query_plan(statement):
+        with app.app_context():
+            sql = str(statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+            rows = db.session.execute(db.text(f"EXPLAIN QUERY PLAN {sql}")).all()
+        return ' | '.join(row[-1] for row in rows)
+
+    plan = query_plan(db.select(HeroCounter.id).where(HeroCounter.hero_id == 1))
+    assert 'uq_hero_counters_pair' in plan
+
+    plan = query_plan(db.select(HeroBuild.id).where(HeroBuild.hero_id == 1)
+                      .order_by(HeroBuild.votes.desc(), HeroBuild.id.desc()))
+    assert 'ix_hero_builds_hero_votes' in plan
+    assert 'TEMP B-TREE' not in plan
+
+    plan = query_plan(db.select(BuildComment.id).where(BuildComment.build_id == 1)
+                      .order_by(BuildComment.created_at.desc(), BuildComment.id.desc()))
+    assert 'ix_build_comments_build_created' in plan
+    assert 'TEMP B-TREE' not in plan
+
+
+def test_migrate_db_upgrades_existing_schema(client, init_database):
+    # Тест миграции: старая таблица без новых колонок и индексов, с дублями
+    with app.app_context():
+        db.session.execute(db.text("DROP TABLE hero_counters"))
+        db.session.execute(db.text(
+            "CREATE TABLE hero_counters (id INTEGER PRIMARY KEY, hero_id INTEGER NOT NULL, "
+            "counter_hero_id INTEGER NOT NULL, win_rate FLOAT, reason TEXT, created_at DATETIME)"
+        ))
+        db.session.execute(db.text(
+            "INSERT INTO hero_counters (id, hero_id, counter_hero_id, win_rate, reason) VALUES "
+            "(1, 1, 2, 60, 'High win rate of 60% in 100 matches'), (2, 1, 2, 61, 'manual note')"
+        ))
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['migrate-db'])
+    assert result.exit_code == 0
+    assert 'added column hero_counters.source' in result.output
+    assert 'created index uq_hero_counters_pair' in result.output
+
+    with app.app_context():
+        rows = db.session.execute(db.text("SELECT id, source FROM hero_counters")).all()
+        assert [tuple(row) for row in rows] == [(2, 'manual')]
+
+    result = app.test_cli_runner().invoke(args=['migrate-db'])
+    assert 'Database schema is up to date' in result.output
+
+
+def test_builds_keyset_pagination(client, init_database):
+    # Тест постраничной выдачи сборок по курсору
+    with app.app_context():
+        for votes in (5, 9, 1, 5):
+            db.session.add(HeroBuild(hero_id=1, name=f"Build {votes}", items=[1], skills=[1], votes=votes))
+        db.session.commit()
+
+    seen = []
+    url = '/api/heroes/1/builds?limit=2'
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        page = json.loads(response.data)
+        assert len(page) <= 2
+        seen.extend((build['votes'], build['id']) for build in page)
+        cursor = response.headers.get('X-Next-Cursor')
+        url = f'/api/heroes/1/builds?limit=2&cursor={cursor}' if cursor else None
+
+    assert seen == sorted(seen, reverse=True)
+    assert len(seen) == len(set(seen)) == 5
+
+    # Курсор с нецелыми значениями отклоняется, как и у комментариев
+    for values in (['x', 'y'], [5, 1.5], [True, 1], [5]):
+        cursor = app_module.encode_cursor(values)
+        assert client.get(f'/api/heroes/1/builds?cursor={cursor}').status_code == 400
+
+
+def test_comments_keyset_pagination(client, init_database):
+    # Тест постраничной выдачи комментариев и проверки курсора
+    from datetime import datetime
+
+    with app.app_context():
+        for i in range(4):
+            db.session.add(BuildComment(build_id=1, author=f"User {i}", content="text",
+                                        created_at=datetime(2024, 1, 1 + i % 2)))
+        db.session.commit()
+
+    first = client.get('/api/builds/1/comments?limit=3')
+    assert len(json.loads(first.data)) == 3
+    cursor = first.headers['X-Next-Cursor']
+
+    second = client.get(f'/api/builds/1/comments?limit=3&cursor={cursor}')
+    assert len(json.loads(second.data)) == 2
+    assert 'X-Next-Cursor' not in second.headers
+
+    ids = [c['id'] for c in json.loads(first.data) + json.loads(second.data)]
+    assert len(set(ids)) == 5
+
+    assert client.get('/api/builds/1/comments?cursor=garbage').status_code == 400
+    cursor = app_module.encode_cursor(['2024-01-01T00:00:00', 'x'])
+    assert client.get(f'/api/builds/1/comments?cursor={cursor}').status_code == 400
+
+
+def test_vote_build_batched(client, init_database):
+    # Тест отложенной пакетной записи голосов
+    from app import vote_aggregator
+
+    app.config['VOTE_BATCHING'] = True
+    vote_aggregator.interval = 60  # сбрасываем вручную, без фонового потока
+    try:
+        votes = []
+        for vote in (1, 1, -1, 3):
+            response = client.post('/api/builds/1/vote', data=json.dumps({'vote': vote}),
+                                   content_type='application/json')
+            votes.append(json.loads(response.data)['votes'])
+        vote_aggregator.flush()
+    finally:
+        app.config['VOTE_BATCHING'] = False
+
+    assert votes[-1] == 9
+    with app.app_context():
+        assert db.session.get(HeroBuild, 1).votes == 9
+
+    assert client.post('/api/builds/999/vote', data=json.dumps({'vote': 1}),
+                       content_type='application/json').status_code == 404
+    assert client.post('/api/builds/1/vote', data=json.dumps({'vote': 'many'}),
+                       content_type='application/json').status_code == 400
+
+
+def test_matchup_matrix_derives_counters_in_bulk(tmp_path):
+    # Тест матрицы матчапов: винрейты, интервалы и контрпики для всех героев
+    from matchups import MatchupMatrix
+
+    matrix = MatchupMatrix(size=4)
+    matrix.set_row(1, [{'hero_id': 2, 'games_played': 200, 'wins': 120},
+                       {'hero_id': 3, 'games_played': 100, 'wins': 50}])
+    matrix.set_row(2, [{'hero_id': 7, 'games_played': 10, 'wins': 9}])
+
+    assert matrix.size >= 8
+    assert [c['hero_id'] for c in matrix.counters_for(1, 53)] == [2]
+    counter = matrix.counters_for(2, 53)[0]
+    assert counter['win_rate'] == 90.0
+    assert counter['ci_low'] < 90.0 < counter['ci_high']
+    assert matrix.counters_for(3, 53) is None
+
+    path = str(tmp_path / 'matchups.npy')
+    matrix.save(path)
+    loaded = MatchupMatrix.load(path)
+    assert loaded.counters_for(1, 53) == matrix.counters_for(1, 53)
+    assert loaded.counters_for(3, 53) is None
+
+    loaded.set_row(3, [{'hero_id': 1, 'games_played': 10, 'wins': 6}])
+    assert [c['hero_id'] for c in loaded.counters_for(3, 53)] == [1]
+
+
+@patch('app.fetch_opendota_data')
+def test_counters_use_matchup_matrix_slice(mock_fetch, client, init_database):
+    # Тест: после загрузки строки матрицы OpenDota больше не опрашивается
+    from app import calculate_counters
+
+    mock_fetch.return_value = [{'hero_id': 2, 'games_played': 100, 'wins': 60}]
+    with app.app_context():
+        assert [c['hero_id'] for c in calculate_counters(1)] == [2]
+        assert [c['hero_id'] for c in calculate_counters(1)] == [2]
+    assert mock_fetch.call_count == 1
+
+
+@patch('app.fetch_opendota_data')
+def test_build_synergies_and_score_draft(mock_fetch, client, init_database):
+    # Тест: таблица синергий строится по publicMatches и используется в analyze_draft
+    from app import analyze_draft
+
+    mock_fetch.side_effect = lambda endpoint: [
+        {'match_id': 10, 'radiant_win': True, 'radiant_team': [1, 2, 3, 4, 5], 'dire_team': '6,7,8,9,10'},
+        {'match_id': 11, 'radiant_win': False, 'radiant_team': [1, 2, 6, 7, 8], 'dire_team': [3, 4, 5, 9, 10]}
+    ] if endpoint == 'publicMatches' else []
+
+    result = app.test_cli_runner().invoke(args=['build-synergies', '--pages', '2', '--min-games', '1'])
+    assert result.exit_code == 0
+    assert 'Built synergies from 2 matches' in result.output
+
+    with app.app_context():
+        pair = HeroSynergy.query.filter_by(hero_id=1, synergy_hero_id=2).one()
+        assert pair.win_rate == 50.0
+        assert HeroSynergy.query.filter_by(hero_id=2, synergy_hero_id=1).count() == 1
+
+    matchup_matrix.set_row(1, [{'hero_id': 6, 'games_played': 100, 'wins': 70}])
+    draft = analyze_draft({'players': [{'hero_id': hero_id} for hero_id in range(1, 11)]})
+
+    # Пары 1-5: 13 побед в 14 совместных играх; пары 6-10: 1 победа из 14
+    assert draft['synergy_score'] == 92.86
+    assert draft['dire_synergy_score'] == 7.14
+    assert draft['counter_score'] == 70.0
+
+
+def test_draft_recommend_ranks_remaining_heroes(client, init_database):
+    # Тест рекомендаций драфта: синергия с союзниками и контрпик врагов
+    with app.app_context():
+        for hero_id in (3, 4):
+            db.session.add(Hero(id=hero_id, name=f"npc_dota_hero_{hero_id}", localized_name=f"Hero {hero_id}"))
+        db.session.commit()
+    hero_registry.invalidate()
+
+    app_module.synergy_matrix.add_allies([1, 3], True)
+    matchup_matrix.set_row(4, [{'hero_id': 2, 'games_played': 10, 'wins': 8}])
+
+    response = client.post('/api/draft/recommend',
+                           data=json.dumps({'radiant': [1], 'dire': [2], 'bans': [], 'side': 'radiant'}),
+                           content_type='application/json')
+    assert response.status_code == 200
+    recommendations = json.loads(response.data)['recommendations']
+
+    assert [r['hero_id'] for r in recommendations] == [3, 4]
+    assert recommendations[0]['synergy'] == 100.0
+    assert recommendations[1]['counter'] == 80.0
+
+    response = client.post('/api/draft/recommend',
+                           data=json.dumps({'radiant': [1], 'dire': [1]}),
+                           content_type='application/json')
+    assert response.status_code == 400
+
+    # Тело не объект и логические значения вместо id героев - 400
+    for body in ([1, 2], 'radiant', {'radiant': [True]}, {'bans': [False]}):
+        response = client.post('/api/draft/recommend', data=json.dumps(body), content_type='application/json')
+        assert response.status_code == 400
+
+
+@patch('app.fetch_opendota_data')
+def test_match_analyses_batch(mock_fetch, client, init_database):
+    # Тест пакетного анализа: сохраненные из БД, недостающие из OpenDota, одна транзакция
+    mock_fetch.side_effect = lambda endpoint: None if endpoint == 'matches/3' else {
+        'match_id': int(endpoint.split('/')[1]),
+        'radiant_win': False,
+        'duration': 1800,
+        'players': [{'hero_id': 1, 'kills': 3}, {'hero_id': 2, 'kills': 7}]
+    }
+
+    response = client.post('/api/matches/batch',
+                           data=json.dumps({'match_ids': [1234567890, 1, 2, 3, 1]}),
+                           content_type='application/json')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert lines[0]['match_id'] == 1234567890
+    assert {line['match_id'] for line in lines[1:-1] if 'error' not in line} == {1, 2}
+    assert {'match_id': 3, 'error': 'Match not found'} in lines
+    assert lines[-1] == {'stored': 1, 'created': 2, 'stored_concurrently': 0, 'not_found': 1}
+    # В сохраненном анализе была только draft_analysis - остальные секции досчитаны по матчу
+    assert set(lines[0]['analysis']) == {'draft_analysis', 'key_moments', 'performance_metrics'}
+    assert mock_fetch.call_count == 4
+
+    with app.app_context():
+        assert MatchAnalysis.query.count() == 3
+
+    for body in ({'match_ids': 'all'}, {'match_ids': [1, True]}, [1, 2], 7):
+        response = client.post('/api/matches/batch', data=json.dumps(body), content_type='application/json')
+        assert response.status_code == 400
+
+
+@patch('app.fetch_opendota_data')
+def test_match_analyses_batch_streams_only_committed(mock_fetch, client, init_database):
+    # Тест: новые анализы отдаются только после коммита, параллельно сохраненные считаются отдельно
+    mock_fetch.side_effect = lambda endpoint: {
+        'match_id': int(endpoint.split('/')[1]), 'radiant_win': True, 'duration': 1800,
+        'players': [{'hero_id': 1, 'kills': 3}]
+    }
+    build = app_module.build_match_analysis
+
+    def build_with_race(match_id, match_data, analysis=None):
+        if match_id == 12:
+            # Тот же матч успел сохранить другой запрос
+            db.session.execute(db.insert(MatchAnalysis).values(match_id=12, duration=999))
+        return build(match_id, match_data, analysis)
+
+    with patch('app.build_match_analysis', side_effect=build_with_race):
+        response = client.post('/api/matches/batch', json={'match_ids': [11, 12]})
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert sorted(line['match_id'] for line in lines[:-1]) == [11, 12]
+    assert next(line for line in lines if line.get('match_id') == 12)['duration'] == 999
+    assert lines[-1] == {'stored': 0, 'created': 1, 'stored_concurrently': 1, 'not_found': 0}
+
+    # Коммит не удался - несохраненные анализы клиенту не отдаются
+    with patch('app.record_match_pairs', side_effect=app_module.SQLAlchemyError('boom')):
+        response = client.post('/api/matches/batch', json={'match_ids': [13]})
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert lines == [{'error': 'Internal server error'}]
+    with app.app_context():
+        assert MatchAnalysis.query.filter_by(match_id=13).first() is None
+
+
+@patch('app.fetch_opendota_data')
+def test_async_match_analysis_job(mock_fetch, client, init_database):
+    # Тест асинхронного анализа: 202 с заданием, результат по ссылке на задание
+    mock_fetch.side_effect = lambda endpoint: None if endpoint == 'matches/404' else {
+        'match_id': 555, 'radiant_win': True, 'duration': 2000,
+        'players': [{'hero_id': 1, 'kills': 4}]
+    }
+    app.config['JOB_WORKERS'] = 0
+    try:
+        response = client.get('/api/matches/555?async=1')
+        assert response.status_code == 202
+        job = json.loads(response.data)
+        assert response.headers['Location'].endswith(f"/api/jobs/{job['job_id']}")
+
+        response = client.get(f"/api/jobs/{job['job_id']}?wait=1")
+        data = json.loads(response.data)
+        assert data['status'] == 'done'
+        assert data['result']['match_id'] == 555
+        assert data['result']['analysis']['performance_metrics'][0]['kills'] == 4
+
+        # Анализ уже сохранен - обычный ответ 200
+        assert client.get('/api/matches/555?async=1').status_code == 200
+
+        job = json.loads(client.get('/api/matches/404?async=1').data)
+        data = json.loads(client.get(f"/api/jobs/{job['job_id']}").data)
+        assert data['status'] == 'failed'
+        assert data['error'] == 'Match not found'
+    finally:
+        app.config['JOB_WORKERS'] = os.cpu_count() or 1
+
+    assert client.get('/api/jobs/unknown').status_code == 404
+
+
+def test_run_analysis_worker_returns_plain_data(tmp_path):
+    # Тест функции процесса-исполнителя: только данные, без ORM-объектов
+    from app import run_analysis_worker
+
+    app.config['MATCH_ARCHIVE_DIR'] = str(tmp_path / 'match_archive')
+    app.config['SHARED_CACHE_DIR'] = str(tmp_path / 'shared_cache')
+
+    # Оценки драфта (матрицы пар из БД при PAIR_STATS_SOURCE=local) считает родитель в finish_job
+    app.config['PAIR_STATS_SOURCE'] = 'local'
+    app_module.reset_local_pair_matrices()
+    try:
+        with patch('app.fetch_opendota_data', return_value={'radiant_win': False, 'duration': 100, 'players': []}):
+            with count_queries() as statements:
+                result = run_analysis_worker(1)
+    finally:
+        app.config['PAIR_STATS_SOURCE'] = 'opendota'
+    assert statements == []
+    assert result['radiant_win'] is False
+    assert result['teams'] == ([], [])
+    assert set(result['analysis']) == {'key_moments', 'performance_metrics'}
+
+
+def test_match_archive_segments_and_index(tmp_path):
+    # Тест архива: ротация сегментов, перезапись матча, индекс переживает переоткрытие
+    from archive import MatchArchive, decode_record
+
+    archive = MatchArchive(str(tmp_path), segment_size=64)
+    for match_id in range(1, 6):
+        archive.append(match_id, {'match_id': match_id, 'players': [{'hero_id': match_id}] * 10})
+    archive.append(3, {'match_id': 3, 'duration': 42})
+
+    assert len([name for name in os.listdir(tmp_path) if name.startswith('segment-')]) > 1
+    assert archive.get(3) == {'match_id': 3, 'duration': 42}
+    assert archive.get(99) is None
+
+    reopened = MatchArchive(str(tmp_path))
+    assert len(reopened) == 5
+    assert 5 in reopened
+    records = {match_id: decode_record(data) for match_id, data in reopened.iter_compressed()}
+    assert records[3] == {'match_id': 3, 'duration': 42}
+    assert records[1]['players'][0] == {'hero_id': 1}
+
+
+@patch('archive.INITIAL_SLOTS', 4)
+def test_match_archive_index_table(tmp_path):
+    # Тест индекса-хэш-таблицы: рост в новое поколение виден другому экземпляру,
+    # индекс прежнего формата (журнал index.bin) переносится при открытии
+    import zlib
+    from archive import INDEX_RECORD, MatchArchive
+
+    writer, reader = MatchArchive(str(tmp_path / 'a')), MatchArchive(str(tmp_path / 'a'))
+    assert reader.get(1) is None
+    for match_id in range(1, 40):
+        writer.append(match_id, {'match_id': match_id})
+    writer.append(7, {'match_id': 7, 'duration': 1})
+
+    assert reader.get(39) == {'match_id': 39}
+    assert reader.get(7) == {'match_id': 7, 'duration': 1}
+    assert len(reader) == 39
+    assert len([name for name in os.listdir(tmp_path / 'a') if name.endswith('.tbl')]) == 1
+
+    legacy = tmp_path / 'b'
+    legacy.mkdir()
+    data = zlib.compress(b'{"match_id": 5}')
+    (legacy / 'segment-00001.z').write_bytes(data)
+    (legacy / 'index.bin').write_bytes(INDEX_RECORD.pack(5, 1, 0, len(data)))
+    assert MatchArchive(str(legacy)).get(5) == {'match_id': 5}
+
+
+@patch('app.fetch_opendota_data')
+def test_reanalyze_from_archive(mock_fetch, client, init_database):
+    # Тест повторного анализа: сырой матч берется из архива, сеть не нужна
+    mock_fetch.return_value = {
+        'match_id': 777, 'radiant_win': True, 'duration': 1800,
+        'players': [{'hero_id': 1, 'kills': 3}]
+    }
+    assert client.get('/api/matches/777').status_code == 200
+    assert mock_fetch.call_count == 1
+
+    with app.app_context():
+        analysis = MatchAnalysis.query.filter_by(match_id=777).first()
+        analysis.analysis = {'outdated': True}
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['reanalyze', '--workers', '0'])
+    assert result.exit_code == 0, result.output
+    assert '1 analyses updated' in result.output
+    assert mock_fetch.call_count == 1
+
+    with app.app_context():
+        analysis = MatchAnalysis.query.filter_by(match_id=777).first()
+        assert analysis.analysis['performance_metrics'][0]['kills'] == 3
+        # Оценки драфта досчитаны в родителе, порядок секций - как при обычном анализе
+        assert list(analysis.analysis) == list(app_module.ANALYSIS_SECTIONS)
+
+    # Удаленный анализ восстанавливается из архива без запроса к OpenDota
+    client.delete('/api/matches/777')
+    assert client.get('/api/matches/777').status_code == 200
+    assert mock_fetch.call_count == 1
+
+
+def test_compact_analysis_codec():
+    # Тест компактного формата: точный возврат, в том числе нестандартных анализов
+    from codec import decode_analysis, encode_analysis
+
+    analysis = {
+        'draft_analysis': {'radiant_heroes': [1, 2], 'dire_heroes': [3], 'synergy_score': 51.5},
+        'key_moments': [{'time': t, 'type': 'building_kill', 'team': 2} for t in range(50)],
+        'performance_metrics': [{'hero_id': 1, 'kills': 3}, {'hero_id': 2, 'kills': 0}]
+    }
+    blob = encode_analysis(analysis)
+    assert decode_analysis(blob) == analysis
+    assert len(blob) < len(json.dumps(analysis)) / 4
+
+    for value in ({'key_moments': [{'time': 1}, {'time': 2, 'extra': True}]}, {'key_moments': []}, [1, 2], 'note'):
+        assert decode_analysis(encode_analysis(value)) == value
+
+
+@patch('app.fetch_opendota_data', return_value=None)
+def test_compact_analysis_storage_and_migration(mock_fetch, client, init_database):
+    # Тест хранения анализа в compact: API не меняется, migrate-analysis конвертирует в обе стороны
+    MatchAnalysis.storage = 'compact'
+    try:
+        response = client.patch('/api/matches/1234567890',
+                                 data=json.dumps({'analysis': {'key_moments': [{'time': 5, 'type': 'x'}]}}),
+                                 content_type='application/json')
+        assert json.loads(response.data)['analysis'] == {'key_moments': [{'time': 5, 'type': 'x'}]}
+        with app.app_context():
+            stored = MatchAnalysis.query.filter_by(match_id=1234567890).first()
+            assert stored.analysis_json is None and stored.analysis_blob is not None
+        data = json.loads(client.get('/api/matches/1234567890').data)
+        assert data['analysis'] == {'key_moments': [{'time': 5, 'type': 'x'}]}
+    finally:
+        MatchAnalysis.storage = 'json'
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['migrate-analysis', '--to', 'json'])
+    assert 'Migrated 1 analyses to json' in result.output
+    with app.app_context():
+        stored = MatchAnalysis.query.filter_by(match_id=1234567890).first()
+        assert stored.analysis_blob is None
+        assert stored.analysis_json == {'key_moments': [{'time': 5, 'type': 'x'}]}
+
+    result = runner.invoke(args=['migrate-analysis', '--to', 'compact'])
+    assert 'Migrated 1 analyses to compact' in result.output
+    data = json.loads(client.get('/api/matches/1234567890').data)
+    assert data['analysis'] == {'key_moments': [{'time': 5, 'type': 'x'}]}
+
+
+@patch('app.fetch_opendota_data')
+def test_match_analysis_sections(mock_fetch, client, init_database):
+    # Тест ?sections=: считаются и отдаются только запрошенные секции, остальные дописываются позже
+    mock_fetch.return_value = {
+        'match_id': 42, 'radiant_win': False, 'duration': 1500,
+        'players': [{'hero_id': 1, 'kills': 7}, {'hero_id': 2, 'kills': 1}],
+        'objectives': [{'time': 300, 'type': 'CHAT_MESSAGE_FIRSTBLOOD'}]
+    }
+
+    with patch('app.identify_key_moments', wraps=app_module.identify_key_moments) as moments:
+        app_module.ANALYSIS_SECTIONS['key_moments'] = moments
+        try:
+            response = client.get('/api/matches/42?sections=draft_analysis')
+            assert response.status_code == 200
+            assert list(json.loads(response.data)['analysis']) == ['draft_analysis']
+            assert moments.call_count == 0
+
+            data = json.loads(client.get('/api/matches/42?sections=key_moments,performance_metrics').data)
+            assert list(data['analysis']) == ['key_moments', 'performance_metrics']
+            assert data['analysis']['key_moments'][0]['time'] == 300
+            assert moments.call_count == 1
+        finally:
+            app_module.ANALYSIS_SECTIONS['key_moments'] = app_module.identify_key_moments
+
+    # Сырой матч взят из архива, повторно в OpenDota не ходили
+    assert mock_fetch.call_count == 1
+    with app.app_context():
+        stored = MatchAnalysis.query.filter_by(match_id=42).first().analysis
+        assert set(stored) == {'draft_analysis', 'key_moments', 'performance_metrics'}
+
+    assert client.get('/api/matches/42?sections=scoreboard').status_code == 400
+
+
+@patch('app.fetch_opendota_data')
+def test_full_request_after_partial_sections(mock_fetch, client, init_database):
+    # Тест: запрос без sections после частичного досчитывает недостающие секции
+    mock_fetch.return_value = {
+        'match_id': 77, 'radiant_win': True, 'duration': 2100,
+        'players': [{'hero_id': 1, 'kills': 5}, {'hero_id': 2, 'kills': 2}],
+        'objectives': [{'time': 120, 'type': 'CHAT_MESSAGE_FIRSTBLOOD'}]
+    }
+
+    data = json.loads(client.get('/api/matches/77?sections=draft_analysis').data)
+    assert list(data['analysis']) == ['draft_analysis']
+
+    data = json.loads(client.get('/api/matches/77').data)
+    assert list(data['analysis']) == ['draft_analysis', 'key_moments', 'performance_metrics']
+    assert data['analysis']['key_moments'][0]['time'] == 120
+    # Второй раз матч взят из архива
+    assert mock_fetch.call_count == 1
+    with app.app_context():
+        stored = MatchAnalysis.query.filter_by(match_id=77).first().analysis
+        assert set(stored) == {'draft_analysis', 'key_moments', 'performance_metrics'}
+
+
+@patch('app.fetch_opendota_data')
+def test_match_moments_timeline(mock_fetch, client, init_database):
+    # Тест запросов к таймлайну: отрезок времени, тип и команда по индексу моментов
+    mock_fetch.return_value = {
+        'match_id': 43, 'radiant_win': True, 'duration': 3000, 'players': [],
+        'objectives': [
+            {'time': 900, 'type': 'building_kill', 'team': 2},
+            {'time': 120, 'type': 'CHAT_MESSAGE_FIRSTBLOOD', 'team': 3},
+            {'time': 1500, 'type': 'CHAT_MESSAGE_ROSHAN_KILL', 'team': 2},
+            {'time': 1800, 'type': 'building_kill', 'team': 3},
+            {'time': 2400, 'type': 'building_kill', 'team': 2}
+        ]
+    }
+    assert client.get('/api/matches/43').status_code == 200
+    with app.app_context():
+        index = MatchAnalysis.query.filter_by(match_id=43).first().moments_index
+        assert index['types']['building_kill'][0] == [900, 1800, 2400]
+
+    data = json.loads(client.get('/api/matches/43/moments?from=900&to=1800').data)
+    assert [moment['time'] for moment in data['moments']] == [900, 1500, 1800]
+
+    data = json.loads(client.get('/api/matches/43/moments?type=building_kill&team=2&from=1000').data)
+    assert [moment['time'] for moment in data['moments']] == [2400]
+
+    data = json.loads(client.get('/api/matches/43/moments?type=CHAT_MESSAGE_AEGIS').data)
+    assert data == {'match_id': 43, 'count': 0, 'moments': []}
+
+    # Нечисловые границы и команда - 400, а не молчаливый пропуск фильтра
+    for query in ('from=abc', 'to=10m', 'team=radiant'):
+        assert client.get(f'/api/matches/43/moments?{query}').status_code == 400
+
+    # Анализ без key_moments: секция досчитывается и индексируется при записи
+    data = json.loads(client.get('/api/matches/1234567890/moments?to=200').data)
+    assert data['moments'][0]['time'] == 120
+    assert mock_fetch.call_count == 2
+
+
+@patch('app.fetch_opendota_data')
+def test_hero_performance_rollups(mock_fetch, client, init_database):
+    # Тест сводки по героям: вставка, изменение и удаление анализа меняют суммы инкрементально
+    mock_fetch.side_effect = lambda endpoint: {
+        'matches/1': {'radiant_win': True, 'duration': 1500, 'players': [
+            {'hero_id': 1, 'kills': 10, 'gold_per_min': 600}, {'hero_id': 2, 'kills': 1}]},
+        'matches/2': {'radiant_win': False, 'duration': 2700, 'players': [
+            {'hero_id': 1, 'kills': 4, 'gold_per_min': 400}]}
+    }.get(endpoint)
+    client.get('/api/matches/1')
+    client.get('/api/matches/2')
+
+    data = json.loads(client.get('/api/heroes/1/stats').data)
+    assert data['matches'] == 2
+    assert data['metrics']['kills'] == {'avg': 7.0, 'stddev': 4.24}
+    assert data['metrics']['gpm']['avg'] == 500.0
+    assert [(bucket['min_minutes'], bucket['max_minutes'], bucket['matches'])
+            for bucket in data['by_duration']] == [(20, 30, 1), (40, 50, 1)]
+
+    client.patch('/api/matches/2', data=json.dumps({'analysis': {'performance_metrics': [
+        {'hero_id': 1, 'kills': 6, 'gpm': 400}]}}), content_type='application/json')
+    data = json.loads(client.get('/api/heroes/1/stats').data)
+    assert data['metrics']['kills']['avg'] == 8.0
+
+    client.delete('/api/matches/1')
+    data = json.loads(client.get('/api/heroes/1/stats').data)
+    assert data['matches'] == 1
+    assert data['metrics']['kills'] == {'avg': 6.0, 'stddev': 0.0}
+    assert json.loads(client.get('/api/heroes/2/stats').data) == {
+        'hero_id': 2, 'matches': 0, 'metrics': {}, 'by_duration': []}
+
+    # Полный пересчет дает то же, что инкрементальные обновления
+    result = app.test_cli_runner().invoke(args=['rebuild-hero-stats'])
+    assert 'Hero stats rebuilt from 2 analyses' in result.output
+    assert json.loads(client.get('/api/heroes/1/stats').data)['metrics']['kills']['avg'] == 6.0
+
+
+@patch('app.fetch_opendota_data')
+def test_local_pair_stats_from_stored_matches(mock_fetch, client, init_database):
+    # Тест пар героев из своих матчей: 25 пар противников и 20 пар союзников на матч,
+    # контрпики и синергии считаются без OpenDota при PAIR_STATS_SOURCE=local
+    def match(radiant_win):
+        return {'radiant_win': radiant_win, 'duration': 2000,
+                'players': [{'hero_id': hero_id} for hero_id in (1, 3, 4, 5, 6, 2, 7, 8, 9, 10)]}
+
+    mock_fetch.side_effect = lambda endpoint: match(endpoint != 'matches/3')
+    app.config['PAIR_STATS_SOURCE'] = 'local'
+    try:
+        for match_id in (1, 2, 3):
+            client.get(f'/api/matches/{match_id}')
+
+        with app.app_context():
+            assert HeroPairStat.query.count() == 45
+            pair = HeroPairStat.query.filter_by(hero_id=1, other_hero_id=2, relation='enemy').one()
+            assert (pair.games, pair.wins) == (3, 2)
+            ally = HeroPairStat.query.filter_by(hero_id=1, other_hero_id=3, relation='ally').one()
+            assert (ally.games, ally.wins) == (3, 2)
+
+        mock_fetch.reset_mock()
+        with app.app_context():
+            counters = app_module.calculate_counters(1)
+        assert {counter['hero_id'] for counter in counters} == {2}
+        assert counters[0]['win_rate'] == 66.67
+        assert mock_fetch.call_count == 0
+
+        # Новый матч сразу попадает в загруженные матрицы
+        mock_fetch.side_effect = lambda endpoint: match(False)
+        client.get('/api/matches/4')
+        synergies, matchups = app_module.pair_matrices()
+        assert matchups.pair_win_rate([1], [2]) == 50.0
+        assert synergies.pair_win_rate([1], [3], symmetric=True) == 50.0
+
+        # Матч, записанный другим воркером: после смены версии в общем кэше матрицы перечитываются
+        from rollups import match_pairs, update_pair_stats
+        from shared_cache import SharedCache
+        with app.app_context():
+            update_pair_stats(match_pairs([1, 3, 4, 5, 6], [2, 7, 8, 9, 10], True))
+            db.session.commit()
+        SharedCache(app.config['SHARED_CACHE_DIR']).bump(app_module.PAIR_STATS_KEY)
+        with app.app_context():
+            synergies, matchups = app_module.pair_matrices()
+        assert matchups.pair_win_rate([1], [2]) == 60.0
+        assert synergies.pair_win_rate([1], [3], symmetric=True) == 60.0
+    finally:
+        app.config['PAIR_STATS_SOURCE'] = 'opendota'
+
+
+@patch('app.fetch_opendota_data')
+def test_delete_match_removes_pair_stats(mock_fetch, client, init_database):
+    # Тест удаления матча: его пары вычитаются из hero_pair_stats и из загруженных матриц,
+    # повторная загрузка матча учитывает его ровно один раз
+    mock_fetch.side_effect = lambda endpoint: {
+        'radiant_win': endpoint == 'matches/1', 'duration': 2000,
+        'players': [{'hero_id': hero_id} for hero_id in (1, 3, 4, 5, 6, 2, 7, 8, 9, 10)]
+    }
+    app.config['PAIR_STATS_SOURCE'] = 'local'
+    try:
+        client.get('/api/matches/1')
+        client.get('/api/matches/2')
+        synergies, matchups = app_module.pair_matrices()
+        assert matchups.pair_win_rate([1], [2]) == 50.0
+
+        assert client.delete('/api/matches/1').status_code == 200
+        with app.app_context():
+            pair = HeroPairStat.query.filter_by(hero_id=1, other_hero_id=2, relation='enemy').one()
+            assert (pair.games, pair.wins) == (1, 0)
+            synergies, matchups = app_module.pair_matrices()
+        assert matchups.pair_win_rate([1], [2]) == 0.0
+
+        client.get('/api/matches/1')
+        with app.app_context():
+            pair = HeroPairStat.query.filter_by(hero_id=1, other_hero_id=2, relation='enemy').one()
+            assert (pair.games, pair.wins) == (2, 1)
+            ally = HeroPairStat.query.filter_by(hero_id=1, other_hero_id=3, relation='ally').one()
+            assert (ally.games, ally.wins) == (2, 1)
+            synergies, matchups = app_module.pair_matrices()
+        assert matchups.pair_win_rate([1], [2]) == 50.0
+        assert synergies.pair_win_rate([1], [3], symmetric=True) == 50.0
+    finally:
+        app.config['PAIR_STATS_SOURCE'] = 'opendota'
+
+
+def test_json_providers_agree():
+    # Тест JSON-провайдеров: orjson и stdlib дают одинаковый JSON, даты - в ISO 8601
+    from datetime import datetime
+    from jsonprovider import OrjsonProvider, StdlibJSONProvider, orjson
+
+    payload = {'created_at': datetime(2024, 5, 1, 12, 30, 15, 250000), 'b': [1, 2.5, None], 'a': 'Антимаг'}
+    stdlib = StdlibJSONProvider(app)
+    assert json.loads(stdlib.dumps(payload))['created_at'] == '2024-05-01T12:30:15.250000'
+    with app.app_context():
+        assert stdlib.response(payload).get_json()['b'] == [1, 2.5, None]
+    if orjson is not None:
+        assert json.loads(OrjsonProvider(app).dumps(payload)) == json.loads(stdlib.dumps(payload))
+        assert list(json.loads(OrjsonProvider(app).dumps(payload))) == ['created_at', 'b', 'a']
+
+
+def test_serialized_build_shape(client, init_database):
+    # Тест общего сериализатора: одинаковые поля сборки во всех ответах
+    listed = json.loads(client.get('/api/heroes/1/builds').data)[0]
+    single = json.loads(client.get(f"/api/builds/{listed['id']}").data)
+    updated = json.loads(client.patch(f"/api/builds/{listed['id']}", data=json.dumps({'votes': 3}),
+                                      content_type='application/json').data)
+    assert set(listed) == set(single) == set(updated)
+    assert single['created_at'] == listed['created_at']
+    assert updated['votes'] == 3
+
+
+@patch('app.fetch_opendota_data', return_value=None)
+def test_conditional_get_etags(mock_fetch, client, init_database):
+    # Тест условных GET: 304 по ETag и Last-Modified, новая версия после изменения
+    response = client.get('/api/heroes')
+    etag = response.headers['ETag']
+    assert client.get('/api/heroes', headers={'If-None-Match': etag}).status_code == 304
+    hero = client.get('/api/heroes/1')
+    assert client.get('/api/heroes/1', headers={'If-None-Match': hero.headers['ETag']}).status_code == 304
+    assert client.get('/api/heroes/2', headers={'If-None-Match': hero.headers['ETag']}).status_code == 200
+    # Last-Modified справочника - самое позднее updated_at героев
+    assert client.get('/api/heroes', headers={'If-Modified-Since': response.headers['Last-Modified']}).status_code == 304
+    assert client.get('/api/heroes/1', headers={'If-Modified-Since': hero.headers['Last-Modified']}).status_code == 304
+    with app.app_context():
+        newest = db.session.execute(db.select(db.func.max(Hero.updated_at))).scalar()
+    assert response.headers['Last-Modified'] == http_date(newest.replace(tzinfo=timezone.utc))
+
+    build_id = json.loads(client.get('/api/heroes/1/builds').data)[0]['id']
+    response = client.get(f'/api/builds/{build_id}')
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+    with count_queries() as statements:
+        cached = client.get(f'/api/builds/{build_id}', headers={'If-None-Match': etag})
+    assert cached.status_code == 304 and cached.data == b''
+    assert len(statements) == 1
+    assert client.get(f'/api/builds/{build_id}', headers={'If-Modified-Since': last_modified}).status_code == 304
+
+    client.patch(f'/api/builds/{build_id}', data=json.dumps({'name': 'New'}), content_type='application/json')
+    response = client.get(f'/api/builds/{build_id}', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+    response = client.get('/api/matches/1234567890')
+    etag = response.headers['ETag']
+    assert client.get('/api/matches/1234567890', headers={'If-None-Match': etag}).status_code == 304
+    # Другой набор секций - другое представление
+    assert client.get('/api/matches/1234567890?sections=draft_analysis',
+                      headers={'If-None-Match': etag}).status_code == 200
+
+
+@patch('app.fetch_opendota_data', return_value=None)
+def test_response_compression(mock_fetch, client, init_database):
+    # Тест сжатия: gzip для больших ответов по Accept-Encoding, маленькие и без заголовка - как есть
+    import gzip
+
+    client.patch('/api/matches/1234567890', data=json.dumps({'analysis': {'key_moments': [
+        {'time': t, 'type': 'building_kill', 'team': 2} for t in range(200)]}}), content_type='application/json')
+
+    plain = client.get('/api/matches/1234567890')
+    assert 'Content-Encoding' not in plain.headers
+    compressed = client.get('/api/matches/1234567890', headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in compressed.headers['Vary']
+    assert gzip.decompress(compressed.data) == plain.data
+    assert compressed.headers['ETag'] == plain.headers['ETag'][:-1] + '-gzip"'
+    assert client.get('/api/matches/1234567890', headers={
+        'Accept-Encoding': 'gzip', 'If-None-Match': compressed.headers['ETag']}).status_code == 304
+
+    small = client.get('/api/heroes/1', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in small.headers
+
+
+def test_shared_cache_invalidation_across_instances(tmp_path):
+    # Тест: два экземпляра на одном каталоге (как два воркера) видят общие версии
+    from shared_cache import SharedCache
+    first, second = SharedCache(str(tmp_path)), SharedCache(str(tmp_path))
+
+    version = first.version('counters/1')
+    assert first.put('counters/1', {'counters': [1, 2]}, version)
+    assert second.get('counters/1') == {'counters': [1, 2]}
+
+    second.bump('counters/1')
+    assert first.get('counters/1') is None
+    # Значение, посчитанное до инвалидации, не сохраняется
+    assert not first.put('counters/1', {'counters': [1]}, version)
+
+    first.put('heroes', [[1, 'npc_dota_hero_antimage']], first.version('heroes'))
+    second.bump()
+    assert first.get('heroes') is None
+
+
+def test_counters_served_from_shared_cache(client, init_database):
+    # Тест: повторное чтение контрпиков без запросов к БД, запись сбрасывает кэш
+    client.get('/api/heroes')
+    assert len(client.get('/api/heroes/1/counters').get_json()) == 1
+
+    with count_queries() as statements:
+        assert len(client.get('/api/heroes/1/counters').get_json()) == 1
+    assert statements == []
+
+    with app.app_context():
+        db.session.add(Hero(id=3, name='npc_dota_hero_bane', localized_name='Bane'))
+        db.session.commit()
+    hero_registry.invalidate()
+    response = client.post('/api/heroes/1/counters', json={'counter_hero_id': 3, 'win_rate': 55.0})
+    assert response.status_code == 201
+
+    data = client.get('/api/heroes/1/counters').get_json()
+    assert sorted(counter['counter_hero_id'] for counter in data) == [2, 3]
+    assert any(counter['counter_hero_name'] == 'Bane' for counter in data)
+
+
+def test_metrics_endpoint(client, init_database):
+    # Тест: задержки, SQL-запросы по маршрутам и вызовы OpenDota в формате Prometheus
+    # Метрики общие на процесс: сравниваем с состоянием до теста
+    key = 'heroes/{id}/matchups'
+    ok_before = app_module.opendota_requests.value((key, 'ok'))
+    error_before = app_module.opendota_requests.value((key, 'error'))
+    calls_before = app_module.opendota_latency.count((key,))
+
+    client.get('/api/builds/1')
+    with patch.object(opendota, 'fetch', return_value=[]):
+        app_module.fetch_opendota_data('heroes/1/matchups')
+    with patch.object(opendota, 'fetch', side_effect=requests.ConnectionError('down')):
+        app_module.fetch_opendota_data('heroes/2/matchups')
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    text = response.get_data(as_text=True)
+
+    assert 'http_requests_total{method="GET",route="/api/builds/<int:build_id>",status="200"}' in text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/api/builds/<int:build_id>",le="+Inf"} ' in text
+    count_line = next(line for line in text.splitlines()
+                      if line.startswith('http_request_db_queries_count{method="GET",route="/api/builds/<int:build_id>"}'))
+    assert int(count_line.split()[-1]) >= 1
+    sum_line = next(line for line in text.splitlines()
+                    if line.startswith('http_request_db_queries_sum{method="GET",route="/api/builds/<int:build_id>"}'))
+    assert float(sum_line.split()[-1]) >= 1
+    assert f'opendota_requests_total{{endpoint="{key}",outcome="ok"}} {ok_before + 1}' in text
+    assert f'opendota_requests_total{{endpoint="{key}",outcome="error"}} {error_before + 1}' in text
+    assert f'opendota_request_duration_seconds_count{{endpoint="{key}"}} {calls_before + 2}' in text